@@ -0,0 +1,127 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+from logging import getLogger
+import traceback
+from aws_message.codec import get_codec
+from aws_message.crypto import CryptoException
+from aws_message.processor import ProcessorException
+from aws_message.sqs import SQSQueue
+from aws_message.message import Message
+from aws_message.gather import GatherException
+
+
+logger = getLogger(__name__)
+
+
+class AsyncSQSQueue(object):
+    """
+    Coroutine interface to an SQSQueue
+
+    boto3 is blocking, so each receive and delete request is run in
+    the event loop's default executor, leaving the loop free to process
+    messages while a long poll is outstanding.
+    """
+
+    def __init__(self, sqs_settings):
+        self._sqs = SQSQueue(sqs_settings)
+
+    @property
+    def _queue(self):
+        return self._sqs._queue
+
+    @_queue.setter
+    def _queue(self, queue):
+        self._sqs._queue = queue
+
+    async def get_messages(self):
+        return await self._run(self._sqs.get_messages)
+
+    async def delete_messages(self, messages):
+        return await self._run(self._sqs.delete_messages, messages)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, func, *args)
+
+
+class AsyncGather(object):
+    """
+    Class to gather event messages from AWS SQS queue, validate and
+    process their content concurrently on an asyncio event loop
+    """
+
+    def __init__(self,
+                 processor=None,
+                 sqs_settings=None):
+        """
+        :param processor: A sub-class object of MessageBodyProcessor
+        """
+
+        if not processor:
+            raise GatherException('missing event processor')
+
+        self._processor = processor
+        self._settings = sqs_settings if (
+            sqs_settings) else self._processor.get_queue_settings()
+
+        self._queue = AsyncSQSQueue(self._settings)
+        self._codec = get_codec(self._settings.get('JSON_CODEC'))
+
+    async def gather_events(self):
+        messages = await self._queue.get_messages()
+        logger.debug(
+            "GATHER: event contains {} messages".format(len(messages)))
+
+        # PROCESS_WORKERS bounds the messages processed at once
+        in_flight = asyncio.Semaphore(
+            self._settings.get('PROCESS_WORKERS', len(messages) or 1))
+
+        async def bounded(msg):
+            async with in_flight:
+                return await self._process_message(msg)
+
+        results = await asyncio.gather(*[bounded(msg) for msg in messages])
+
+        # inform the queue which messages have been processed
+        processed = [msg for msg, done in zip(messages, results) if done]
+        not_deleted = await self._queue.delete_messages(processed)
+        if not_deleted:
+            logger.error("GATHER: {} processed messages not deleted".format(
+                len(not_deleted)))
+
+    async def _process_message(self, msg):
+        """
+        Validate the message and hand it off for processing
+
+        :returns: True if the message can be deleted from the queue
+        """
+        try:
+            json_body = self._codec.loads(msg.body)
+            logger.debug("GATHER: JSON body: {}".format(json_body))
+
+            message = Message(json_body, self._settings)
+            if self._settings.get('VALIDATE_SNS_SIGNATURE', True):
+                # signature validation may fetch the signing certificate
+                valid = await asyncio.get_running_loop().run_in_executor(
+                    None, message.validate)
+            else:
+                valid = message.validate()
+
+            if valid:
+                extracted_message = message.extract()
+                logger.debug(
+                    "GATHER: processing {}".format(extracted_message))
+
+                await self._processor.process_async(extracted_message)
+            else:
+                logger.debug("GATHER: Message validation failure")
+
+        except (CryptoException, ProcessorException) as err:
+            # log message specific error, abort if unknown error
+            logger.error('{}: {}'.format(
+                err, traceback.format_exc().splitlines()))
+            return False
+
+        return True
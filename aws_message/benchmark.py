@@ -0,0 +1,323 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Throughput benchmark for the Gather pipeline, run against an in-memory
+stand-in for the SQS queue:
+
+    python -m aws_message.benchmark --output baseline.json
+    python -m aws_message.benchmark --baseline baseline.json
+"""
+
+from commonconf import override_settings
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, padding, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from aws_message.crypto import Signature, aes128cbc, public_key_cache
+from aws_message.gather import Gather
+from aws_message.message import Message
+from aws_message.metrics import InMemoryMetrics
+from aws_message.mock_sqs import SQSQueueMock
+from aws_message.processor import MessageBodyProcessor
+from base64 import b64encode
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+SCENARIOS = ['json', 'sns', 'sns_base64', 'sns_signed', 'sns_signed_batch',
+             'encrypted']
+BATCH_SIZES = [1, 10, 50, 100]
+CERT_URL = 'https://sns.us-east-1.amazonaws.com/benchmark.pem'
+TOPIC_ARN = 'arn:aws:sns:us-east-1:111111111111:benchmark'
+AES_KEY = 'BENCHMARK_KEY_FOR_TESTING_123456'
+AES_IV = 'BENCHMARK_IV_012'
+QUEUE_SETTINGS = {
+    'QUEUE_ARN': 'arn:aws:sqs:us-east-1:000000000000:benchmark',
+    'KEY_ID': 'XXXXXXXXXXXXXXXX',
+    'KEY': 'YYYYYYYYYYYYYYYYYYYYYYYY',
+    'WAIT_TIME': 0,
+    'VALIDATE_SNS_SIGNATURE': False,
+}
+
+# run in a fresh interpreter, so that nothing is imported or cached
+COLD_START = '''
+import json, time
+start = time.perf_counter()
+from commonconf import override_settings
+from aws_message.gather import Gather
+from aws_message.mock_sqs import SQSQueueMock
+from aws_message.processor import MessageBodyProcessor
+from aws_message.sqs import sqs_client
+imported = time.perf_counter()
+
+
+class ColdStartProcessor(MessageBodyProcessor):
+    def process_message_body(self, payload):
+        pass
+
+
+with override_settings(AWS_SQS={'BENCHMARK': {}}):
+    gather = Gather(processor=ColdStartProcessor(None, 'BENCHMARK'),
+                    sqs_settings=%r)
+    built = time.perf_counter()
+    sqs_client(gather._queue.key_id, gather._queue.key, gather._queue.region)
+    connected = time.perf_counter()
+    gather._queue._queue = SQSQueueMock()
+    gather._queue._queue.send_message(MessageBody=%r)
+    gather.gather_events()
+    gathered = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'gather_ms': (built - imported) * 1000,
+    'client_ms': (connected - built) * 1000,
+    'first_gather_ms': (gathered - connected) * 1000,
+    'total_ms': (gathered - start) * 1000,
+}))
+'''
+
+PAYLOAD = {
+    'EventID': '00000000-1111-2222-3333-444444444444',
+    'Href': '...',
+    'EventDate': '2018-08-21T21:00:56.832068-07:00',
+    'Previous': {'CurrentEnrollment': 19, 'Status': 'open'},
+    'Current': {'CurrentEnrollment': 20, 'Status': 'closed'},
+}
+
+
+def signing_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'benchmark')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    pem = x509.CertificateBuilder().subject_name(name).issuer_name(
+        name).public_key(key.public_key()).serial_number(1).not_valid_before(
+        now).not_valid_after(now + datetime.timedelta(days=1)).sign(
+        key, hashes.SHA256()).public_bytes(serialization.Encoding.PEM)
+
+    # stands in for the certificate fetched from SigningCertURL
+    public_key_cache.set(CERT_URL, (pem, Signature._load_public_key(pem)))
+    return key
+
+
+def sns_body(message, index, key=None):
+    body = {
+        'Type': 'Notification',
+        'MessageId': '11111111-0000-1111-2222-{:012d}'.format(index),
+        'TopicArn': TOPIC_ARN,
+        'Subject': 'UW Event',
+        'Message': message,
+        'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+        'SignatureVersion': '1',
+        'Signature': '',
+        'SigningCertURL': CERT_URL,
+        'UnsubscribeURL': '',
+    }
+    if key:
+        body['Signature'] = b64encode(key.sign(
+            Message._sign_text(body), PKCS1v15(),
+            hashes.SHA1())).decode('utf-8')
+    return json.dumps(body)
+
+
+def encrypted_payload():
+    padder = padding.PKCS7(128).padder()
+    data = padder.update(json.dumps(PAYLOAD).encode('utf-8')) + (
+        padder.finalize())
+    encryptor = Cipher(algorithms.AES(AES_KEY.encode('utf-8')),
+                       modes.CBC(AES_IV.encode('utf-8'))).encryptor()
+    return {'Body': b64encode(
+        encryptor.update(data) + encryptor.finalize()).decode('utf-8')}
+
+
+def scenario_bodies(scenario, count):
+    payload = json.dumps(PAYLOAD)
+    if scenario == 'json':
+        return [payload] * count
+    if scenario == 'sns':
+        return [sns_body(payload, i) for i in range(count)]
+    if scenario == 'sns_base64':
+        encoded = b64encode(payload.encode('utf-8')).decode('utf-8')
+        return [sns_body(encoded, i) for i in range(count)]
+    if scenario in ('sns_signed', 'sns_signed_batch'):
+        key = signing_key()
+        return [sns_body(payload, i, key) for i in range(count)]
+    if scenario == 'encrypted':
+        return [json.dumps(encrypted_payload())] * count
+
+    raise ValueError('Unknown scenario: {}'.format(scenario))
+
+
+def scenario_settings(scenario, batch_size):
+    settings = dict(QUEUE_SETTINGS,
+                    MESSAGE_GATHER_SIZE=min(batch_size, 10),
+                    POLL_COUNT=max(1, batch_size // 10))
+    if scenario in ('sns_signed', 'sns_signed_batch'):
+        settings['VALIDATE_SNS_SIGNATURE'] = True
+    if scenario == 'sns_signed_batch':
+        settings['BATCH_VALIDATE'] = True
+    return settings
+
+
+def benchmark_processor(scenario):
+    class BenchmarkProcessor(MessageBodyProcessor):
+        aes = aes128cbc(AES_KEY, AES_IV)
+
+        def decrypt_message_body(self, payload):
+            return json.loads(self.aes.decrypt(
+                payload['Body'], unpad=True, b64=True))
+
+        def process_message_body(self, payload):
+            self.count += 1
+
+    processor = BenchmarkProcessor(logging.getLogger(__name__), 'BENCHMARK',
+                                   is_encrypted=(scenario == 'encrypted'))
+    processor.count = 0
+    return processor
+
+
+def run_scenario(scenario, batch_size, count):
+    processor = benchmark_processor(scenario)
+    metrics = InMemoryMetrics(max_samples=count)
+    gather = Gather(processor=processor, metrics=metrics,
+                    sqs_settings=scenario_settings(scenario, batch_size))
+    queue = SQSQueueMock()
+    for body in scenario_bodies(scenario, count):
+        queue.send_message(MessageBody=body)
+    gather._queue._queue = queue
+
+    batch_times = []
+    start = time.perf_counter()
+    while True:
+        batch_start = time.perf_counter()
+        if not gather.gather_events():
+            break
+        batch_times.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start
+    gather.close()
+
+    if processor.count != count:
+        raise RuntimeError('{}: processed {} of {} messages'.format(
+            scenario, processor.count, count))
+
+    batch_times.sort()
+    return {
+        'scenario': scenario,
+        'batch_size': batch_size,
+        'messages': count,
+        'seconds': round(elapsed, 4),
+        'messages_per_second': round(count / elapsed, 1),
+        'batch_p50_ms': round(percentile(batch_times, 50) * 1000, 3),
+        'batch_p99_ms': round(percentile(batch_times, 99) * 1000, 3),
+        'message_p50_ms': round(
+            metrics.percentile('process', 50) * 1000, 3),
+        'message_p99_ms': round(
+            metrics.percentile('process', 99) * 1000, 3),
+    }
+
+
+def cold_start(runs=5):
+    """
+    Time importing the package, building a Gather, creating its SQS
+    client and the first gather_events, each run in a new interpreter
+
+    :returns: dict of the median milliseconds for each step
+    """
+    script = COLD_START % (QUEUE_SETTINGS, json.dumps(PAYLOAD))
+    samples = []
+    for i in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', script], check=True, capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__)))).stdout
+        samples.append(json.loads(output))
+
+    return {step: round(percentile(sorted(s[step] for s in samples), 50), 3)
+            for step in samples[0]}
+
+
+def percentile(ordered, percent):
+    return ordered[int(round((percent / 100.0) * (len(ordered) - 1)))]
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :returns: results whose throughput fell more than tolerance below
+        the matching baseline result
+    """
+    expected = {(r['scenario'], r['batch_size']): r['messages_per_second']
+                for r in baseline['results']}
+    slower = []
+    for result in results:
+        rate = expected.get((result['scenario'], result['batch_size']))
+        if rate and result['messages_per_second'] < rate * (1 - tolerance):
+            slower.append((result, rate))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='messages per scenario and batch size')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--batch-sizes',
+                        default=','.join(str(b) for b in BATCH_SIZES))
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional throughput drop')
+    parser.add_argument('--cold-start', type=int, default=5,
+                        help='cold start runs, 0 to skip')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = []
+    for scenario in args.scenarios.split(','):
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            with override_settings(AWS_SQS={'BENCHMARK': {}}):
+                result = run_scenario(scenario, batch_size, args.messages)
+            results.append(result)
+            print('{scenario:>18} batch {batch_size:>4}: '
+                  '{messages_per_second:>10.1f} msg/s  '
+                  'batch p50 {batch_p50_ms:.3f}ms p99 {batch_p99_ms:.3f}ms'
+                  .format(**result))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    if args.cold_start:
+        report['cold_start'] = cold_start(args.cold_start)
+        print('cold start: import {import_ms:.1f}ms  gather {gather_ms:.1f}ms'
+              '  client {client_ms:.1f}ms  first gather {first_gather_ms:.1f}'
+              'ms  total {total_ms:.1f}ms'.format(**report['cold_start']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for result, rate in slower:
+            print('REGRESSION {scenario} batch {batch_size}: '
+                  '{messages_per_second} msg/s, baseline {rate}'.format(
+                      rate=rate, **result))
+        if slower:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
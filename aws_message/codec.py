@@ -0,0 +1,68 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from logging import getLogger
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = getLogger(__name__)
+
+
+class JSONCodec(object):
+    """
+    Standard library json codec.  Decoding errors raise ValueError.
+    """
+    name = 'json'
+
+    @staticmethod
+    def loads(data):
+        """
+        :param data: str, bytes or bytearray JSON text
+        """
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj)
+
+
+class OrjsonCodec(object):
+    """
+    orjson codec, used when the optional orjson package is installed.
+    Decoding errors raise ValueError.
+    """
+    name = 'orjson'
+
+    @staticmethod
+    def loads(data):
+        """
+        :param data: str, bytes, bytearray or memoryview JSON text
+        """
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+
+def get_codec(name=None):
+    """
+    :param name: 'json' (the default), 'orjson', or 'auto' for orjson
+        when it is installed
+    :returns: the JSON codec class
+    """
+    if name in ('orjson', 'auto'):
+        if orjson is not None:
+            return OrjsonCodec
+        if name == 'orjson':
+            logger.warning('orjson is not installed, using json')
+
+    elif name not in (None, 'json'):
+        raise ValueError('Unknown JSON codec: {}'.format(name))
+
+    return JSONCodec
@@ -1,15 +1,14 @@
 # Copyright 2024 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
+# cryptography, urllib3 and memcached_clients are imported where they
+# are first used, so that importing the package stays cheap
 from commonconf import settings
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.primitives.hashes import SHA1
-from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.exceptions import UnsupportedAlgorithm, InvalidSignature
-from memcached_clients import PymemcacheClient
+from aws_message.cache import TTLCache
+from base64 import b64decode
+from contextlib import contextmanager
 from hashlib import sha1
-import urllib3
+from threading import Lock
 import logging
 
 # shunt warnings to logging
@@ -20,6 +19,69 @@ class CryptoException(Exception):
     pass
 
 
+# parsed signing certificate public keys, keyed by certificate url
+public_key_cache = TTLCache(maxsize=64, ttl=60*60*6)
+
+# recent certificate fetch failures, keyed by certificate url
+cert_failure_cache = TTLCache(maxsize=64, ttl=60)
+
+# certificate fetches share pooled connections, and concurrent cache
+# misses for a certificate url wait on a single fetch.  Fetch locks are
+# kept, with their number of holders and waiters, only while in use.
+_pool_managers = {}
+_fetch_locks = {}
+_lock = Lock()
+
+
+def _pool_manager(cert_file=None, key_file=None):
+    import urllib3
+
+    key = (settings.AWS_CA_BUNDLE, cert_file, key_file)
+    with _lock:
+        if key not in _pool_managers:
+            _pool_managers[key] = urllib3.PoolManager(
+                cert_file=cert_file,
+                key_file=key_file,
+                cert_reqs='CERT_REQUIRED',
+                ca_certs=settings.AWS_CA_BUNDLE
+            )
+        return _pool_managers[key]
+
+
+def _fetch_options():
+    """
+    Timeout and retry policy for certificate fetches
+    """
+    import urllib3
+
+    return {
+        'timeout': urllib3.Timeout(
+            connect=float(getattr(settings, 'AWS_CERT_CONNECT_TIMEOUT', 3)),
+            read=float(getattr(settings, 'AWS_CERT_READ_TIMEOUT', 5))),
+        'retries': urllib3.Retry(
+            total=int(getattr(settings, 'AWS_CERT_RETRIES', 2)),
+            backoff_factor=float(
+                getattr(settings, 'AWS_CERT_RETRY_BACKOFF', 0.5)),
+            status_forcelist=(500, 502, 503, 504)),
+    }
+
+
+@contextmanager
+def _fetch_lock(cert_ref):
+    with _lock:
+        entry = _fetch_locks.setdefault(cert_ref, [Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _fetch_locks[cert_ref]
+
+
 class Signature(object):
     """
     SHA1 with RSA message signature object
@@ -29,6 +91,7 @@ class Signature(object):
     """
 
     _cert = None
+    _public_key = None
 
     def __init__(self, config):
         """
@@ -47,56 +110,224 @@ class Signature(object):
             raise CryptoException('Missing certificate configuration')
 
         if cert['type'].lower() == 'url':
-            cache = PymemcacheClient()
             cert_ref = cert['reference']
-            key = sha1(cert_ref.encode('utf-8')).hexdigest()
-            self._cert = cache.get(key)
-            if self._cert is None:
-                try:
-                    http = urllib3.PoolManager(
-                        cert_file=config.get('cert_file'),
-                        key_file=config.get('key_file'),
-                        cert_reqs='CERT_REQUIRED',
-                        ca_certs=settings.AWS_CA_BUNDLE
-                    )
-                    r = http.request('GET', cert_ref)
-                    if r.status == 200:
-                        self._cert = r.data
-                        cache.set(key, self._cert, expire=60*60*24*7)
-                    else:
-                        raise CryptoException(
-                            'Cannot get certificate {}: status {}'.format(
-                                cert_ref or 'None', r.status))
-                except urllib3.exceptions.HTTPError as err:
-                    raise CryptoException(
-                        'Cannot get certificate {}: {}'.format(
-                            cert_ref or 'None', err))
+            cached = public_key_cache.get(cert_ref)
+            if cached is None:
+                with _fetch_lock(cert_ref):
+                    # a concurrent fetch may have completed while waiting
+                    cached = public_key_cache.get(cert_ref)
+                    if cached is None:
+                        self._raise_recent_failure(cert_ref)
+                        try:
+                            cached = self._fetch_public_key(cert_ref, config)
+                        except CryptoException as err:
+                            cert_failure_cache.set(cert_ref, str(err), ttl=(
+                                float(getattr(
+                                    settings, 'AWS_CERT_FAILURE_TTL', 60))))
+                            raise
+
+            self._cert, self._public_key = cached
         else:
             raise CryptoException('Unrecognized certificate reference type')
 
+    @staticmethod
+    def _raise_recent_failure(cert_ref):
+        failure = cert_failure_cache.get(cert_ref)
+        if failure is not None:
+            raise CryptoException(failure)
+
+    def _fetch_public_key(self, cert_ref, config):
+        from memcached_clients import PymemcacheClient
+        import urllib3
+
+        cache = PymemcacheClient()
+        key = sha1(cert_ref.encode('utf-8')).hexdigest()
+        pem = cache.get(key)
+        if pem is None:
+            try:
+                http = _pool_manager(cert_file=config.get('cert_file'),
+                                     key_file=config.get('key_file'))
+                r = http.request('GET', cert_ref, **_fetch_options())
+                if r.status == 200:
+                    pem = r.data
+                    cache.set(key, pem, expire=60*60*24*7)
+                else:
+                    raise CryptoException(
+                        'Cannot get certificate {}: status {}'.format(
+                            cert_ref or 'None', r.status))
+            except urllib3.exceptions.HTTPError as err:
+                raise CryptoException(
+                    'Cannot get certificate {}: {}'.format(
+                        cert_ref or 'None', err))
+
+        cached = (pem, self._load_public_key(pem))
+        public_key_cache.set(cert_ref, cached)
+        return cached
+
+    @staticmethod
+    def _load_public_key(pem):
+        from cryptography.exceptions import UnsupportedAlgorithm
+        from cryptography.x509 import load_pem_x509_certificate
+
+        try:
+            return load_pem_x509_certificate(pem).public_key()
+        except (ValueError, UnsupportedAlgorithm) as err:
+            raise CryptoException('Cannot validate: {}'.format(err))
+
+    @staticmethod
+    def cache_stats():
+        """
+        Returns hit and miss counts for the parsed public key cache
+        """
+        return public_key_cache.stats()
+
     def validate(self, msg, sig):
-        if self._cert is None:
+        if self._public_key is None:
             raise CryptoException('Cannot validate: no certificate')
 
+        err = _verify(self._public_key, msg, sig)
+        if err is not None:
+            raise CryptoException(err)
+
+
+def _verify(public_key, msg, sig):
+    """
+    :returns: None if valid, otherwise the reason it is not
+    """
+    from cryptography.exceptions import UnsupportedAlgorithm, InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+    from cryptography.hazmat.primitives.hashes import SHA1
+
+    try:
+        public_key.verify(sig, msg, PKCS1v15(), SHA1())
+    except (ValueError, UnsupportedAlgorithm, InvalidSignature) as err:
+        return 'Cannot validate: {}'.format(err)
+
+
+# public keys parsed by signature verification worker processes
+_verify_keys = TTLCache(maxsize=16, ttl=60*60*6)
+
+
+def verify_signature(pem, msg, sig):
+    """
+    Verify a SHA1 with RSA signature using the PEM certificate pem.
+    Defined at module level so that it can be run in a worker process.
+
+    :returns: None if valid, otherwise the reason it is not
+    """
+    public_key = _verify_keys.get(pem)
+    if public_key is None:
         try:
-            cert = load_pem_x509_certificate(self._cert)
-            public_key = cert.public_key()
-            public_key.verify(sig, msg, PKCS1v15(), SHA1())
+            public_key = Signature._load_public_key(pem)
+        except CryptoException as err:
+            return str(err)
+        _verify_keys.set(pem, public_key)
 
-        except (ValueError, UnsupportedAlgorithm, InvalidSignature) as err:
-            raise CryptoException('Cannot validate: {}'.format(err))
+    return _verify(public_key, msg, sig)
+
+
+def validate_signatures(signed, executor=None):
+    """
+    Validate a batch of signatures, resolving each certificate once
+
+    :param signed: list of (certificate url, message, signature) tuples
+    :param executor: optional concurrent.futures executor on which
+        to run the signature verifications
+    :returns: list of None or CryptoException for each signed entry
+    """
+    results = [None] * len(signed)
+    by_cert = {}
+    for i, (cert_ref, msg, sig) in enumerate(signed):
+        by_cert.setdefault(cert_ref, []).append(i)
+
+    pending = []
+    for cert_ref, indexes in by_cert.items():
+        try:
+            pem = Signature({'cert': {
+                'type': 'url', 'reference': cert_ref}})._cert
+        except CryptoException as err:
+            for i in indexes:
+                results[i] = err
+            continue
+
+        for i in indexes:
+            pending.append((i, pem))
+
+    if executor and pending:
+        verified = executor.map(
+            verify_signature,
+            *zip(*[(pem, signed[i][1], signed[i][2]) for i, pem in pending]),
+            chunksize=8)
+    else:
+        verified = [verify_signature(pem, signed[i][1], signed[i][2])
+                    for i, pem in pending]
+
+    for (i, pem), err in zip(pending, verified):
+        if err is not None:
+            results[i] = CryptoException(err)
+
+    return results
+
+
+def _to_bytes_like(msg, b64=False):
+    """
+    :param msg: str, bytes, bytearray or memoryview ciphertext, or its
+        base64 encoding when b64 is True
+    """
+    if b64:
+        return b64decode(msg)
+    if isinstance(msg, str):
+        return msg.encode('utf8')
+    return memoryview(msg)
+
+
+def _decrypt_into(decryptor, data, chunk_size):
+    """
+    Decrypt data in chunks into a single preallocated buffer
+
+    :returns: bytearray of the decrypted data
+    """
+    data = memoryview(data)
+    buf = bytearray(len(data) + 15)
+    out = memoryview(buf)
+    size = 0
+    for i in range(0, len(data), chunk_size):
+        size += decryptor.update_into(data[i:i + chunk_size], out[size:])
+
+    out.release()
+    final = decryptor.finalize()
+    del buf[size:]
+    buf += final
+    return buf
+
+
+def _unpad(buf):
+    """
+    Strip PKCS7 padding in place
+    """
+    pad = buf[-1] if buf else 0
+    if not 0 < pad <= 16 or buf[-pad:] != bytes([pad]) * pad:
+        raise CryptoException('Cannot decrypt message: invalid padding')
+    del buf[-pad:]
+    return buf
 
 
 class aes128cbc(object):
     """
-    Advanced Encryption Standard object
+    Advanced Encryption Standard object, CBC mode
+
+    The key material is set up once, so a single object can decrypt
+    any number of messages.
 
     For reference:
     https://cryptography.io/en/latest/hazmat/primitives/symmetric-encryption/
     """
 
+    CHUNK_SIZE = 64 * 1024
+
     _key = None
     _iv = None
+    _cipher = None
 
     def __init__(self, key, iv):
         if key is None:
@@ -107,18 +338,86 @@ class aes128cbc(object):
         self._key = self.str_to_bytes(key)
         self._iv = self.str_to_bytes(iv)
 
-    def decrypt(self, msg):
-        msg = self.str_to_bytes(msg)
+    def decrypt(self, msg, unpad=False, b64=False):
+        """
+        :param msg: str, bytes, bytearray or memoryview ciphertext
+        :param unpad: strip the PKCS7 padding from the decrypted message
+        :param b64: msg is base64 encoded
+        :returns: decrypted message as bytearray
+        """
         try:
-            cipher = Cipher(algorithms.AES(self._key), modes.CBC(self._iv))
-            decryptor = cipher.decryptor()
-            dct = decryptor.update(msg) + decryptor.finalize()
-            return dct
+            if self._cipher is None:
+                from cryptography.hazmat.primitives.ciphers import (
+                    Cipher, algorithms, modes)
+                self._cipher = Cipher(algorithms.AES(self._key),
+                                      modes.CBC(self._iv))
+            dct = _decrypt_into(self._cipher.decryptor(),
+                                _to_bytes_like(msg, b64), self.CHUNK_SIZE)
         except Exception as err:
             raise CryptoException(f'Cannot decrypt message: {err}')
 
+        return _unpad(dct) if unpad else dct
+
     def str_to_bytes(self, s):
         u_type = type(b''.decode('utf8'))
         if isinstance(s, u_type):
             return s.encode('utf8')
         return s
+
+
+class aesgcm(object):
+    """
+    Advanced Encryption Standard object, GCM mode
+
+    Decrypts messages laid out as nonce, ciphertext and tag unless
+    the nonce is given separately.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    _algorithm = None
+
+    def __init__(self, key):
+        if key is None:
+            raise CryptoException('Missing AES key')
+
+        self._key = key.encode('utf8') if isinstance(key, str) else key
+
+    def decrypt(self, msg, nonce=None, associated_data=None, b64=False):
+        """
+        :param msg: str, bytes, bytearray or memoryview message
+        :param nonce: the nonce, if it does not prefix msg
+        :param associated_data: authenticated data, if any
+        :param b64: msg is base64 encoded
+        :returns: decrypted message as bytearray
+        """
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers import (
+            Cipher, algorithms, modes)
+
+        try:
+            if self._algorithm is None:
+                self._algorithm = algorithms.AES(self._key)
+
+            data = memoryview(_to_bytes_like(msg, b64))
+            if nonce is None:
+                nonce = bytes(data[:self.NONCE_SIZE])
+                data = data[self.NONCE_SIZE:]
+
+            if len(data) < self.TAG_SIZE:
+                raise ValueError('message too short')
+
+            decryptor = Cipher(self._algorithm, modes.GCM(
+                nonce, bytes(data[-self.TAG_SIZE:]))).decryptor()
+            if associated_data:
+                decryptor.authenticate_additional_data(associated_data)
+
+            return _decrypt_into(decryptor, data[:-self.TAG_SIZE],
+                                 self.CHUNK_SIZE)
+        except InvalidTag:
+            raise CryptoException(
+                'Cannot decrypt message: authentication failed')
+        except Exception as err:
+            raise CryptoException(f'Cannot decrypt message: {err}')
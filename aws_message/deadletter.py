@@ -0,0 +1,105 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from abc import ABC, abstractmethod
+from commonconf import settings
+from datetime import datetime, timezone
+from threading import Lock
+import json
+from aws_message.sqs import SQSQueue
+
+
+class DeadLetterException(Exception):
+    pass
+
+
+class DeadLetterSink(ABC):
+    """
+    Destination for messages that repeatedly fail processing
+    """
+
+    @abstractmethod
+    def send(self, msg, reason):
+        """
+        :param msg: the received message to divert
+        :param reason: why it is diverted
+        Raises DeadLetterException if the message cannot be kept
+        """
+        pass
+
+    @staticmethod
+    def _receive_count(msg):
+        return int(msg.attributes.get('ApproximateReceiveCount', 0))
+
+
+class QueueDeadLetterSink(DeadLetterSink):
+    """
+    Sends diverted messages to another SQS queue, with the reason as
+    the DeadLetterReason message attribute
+    """
+
+    def __init__(self, sqs_settings):
+        """
+        :param sqs_settings: the AWS_SQS settings entry of the queue
+        """
+        self._sqs = SQSQueue(sqs_settings)
+
+    def send(self, msg, reason):
+        try:
+            self._sqs.send_message(msg.body, message_attributes={
+                'DeadLetterReason': {
+                    'DataType': 'String', 'StringValue': reason},
+                'ReceiveCount': {
+                    'DataType': 'Number',
+                    'StringValue': str(self._receive_count(msg))},
+            })
+        except Exception as ex:
+            raise DeadLetterException(
+                'Cannot send {} to {}: {}'.format(
+                    msg.message_id, self._sqs.queue_name, ex))
+
+
+class FileDeadLetterSink(DeadLetterSink):
+    """
+    Appends diverted messages to a local file, one JSON object per line
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+
+    def send(self, msg, reason):
+        line = json.dumps({
+            'message_id': msg.message_id,
+            'receive_count': self._receive_count(msg),
+            'reason': reason,
+            'diverted_at': datetime.now(timezone.utc).isoformat(),
+            'attributes': msg.attributes,
+            'body': msg.body,
+        })
+        try:
+            with self._lock, open(self._path, 'a') as f:
+                f.write(line + '\n')
+        except OSError as ex:
+            raise DeadLetterException(
+                'Cannot write {} to {}: {}'.format(
+                    msg.message_id, self._path, ex))
+
+
+def get_dead_letter_sink(sqs_settings):
+    """
+    :param sqs_settings: settings naming DEAD_LETTER_QUEUE, an AWS_SQS
+        settings entry, or DEAD_LETTER_FILE, a file path
+    :returns: the configured DeadLetterSink, or None
+    """
+    queue_name = sqs_settings.get('DEAD_LETTER_QUEUE')
+    if queue_name:
+        try:
+            return QueueDeadLetterSink(settings.AWS_SQS[queue_name])
+        except KeyError:
+            raise DeadLetterException(
+                'No AWS_SQS settings for {}'.format(queue_name))
+
+    path = sqs_settings.get('DEAD_LETTER_FILE')
+    if path:
+        return FileDeadLetterSink(path)
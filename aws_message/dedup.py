@@ -0,0 +1,57 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from aws_message.cache import TTLCache
+from hashlib import sha1
+
+
+class MessageDedup(object):
+    """
+    Record of recently processed message ids, used to suppress duplicate
+    deliveries.  Ids are kept in a local LRU cache, and optionally in
+    memcached to share them between processes.
+    """
+
+    DEFAULT_SIZE = 10000
+    DEFAULT_TTL = 60*60
+
+    def __init__(self, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL,
+                 use_memcached=False):
+        self._ttl = ttl
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._memcached = None
+        if use_memcached:
+            from memcached_clients import PymemcacheClient
+            self._memcached = PymemcacheClient()
+
+    def seen(self, message_id):
+        """
+        :returns: True if message_id was recorded as processed
+        """
+        if message_id is None:
+            return False
+
+        if self._local.get(message_id):
+            return True
+
+        if self._memcached and self._memcached.get(self._key(message_id)):
+            self._local.set(message_id, True)
+            return True
+
+        return False
+
+    def record(self, message_id):
+        if message_id is None:
+            return
+
+        self._local.set(message_id, True)
+        if self._memcached:
+            self._memcached.set(self._key(message_id), 1, expire=self._ttl)
+
+    def stats(self):
+        return self._local.stats()
+
+    @staticmethod
+    def _key(message_id):
+        return 'aws_message.dedup.{}'.format(
+            sha1(message_id.encode('utf-8')).hexdigest())
@@ -1,13 +1,21 @@
 # Copyright 2024 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
-import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from logging import getLogger
+from queue import Queue, Empty
+from threading import Event, Thread, current_thread, main_thread
+import signal
+import time
 import traceback
+from aws_message.codec import get_codec
 from aws_message.crypto import CryptoException
+from aws_message.deadletter import DeadLetterException, get_dead_letter_sink
+from aws_message.dedup import MessageDedup
 from aws_message.processor import ProcessorException
-from aws_message.sqs import SQSQueue
+from aws_message.sqs import SQSQueue, VisibilityHeartbeat, sqs_client
 from aws_message.message import Message
+from aws_message.metrics import Metrics
 
 
 logger = getLogger(__name__)
@@ -17,56 +25,687 @@ class GatherException(Exception):
     pass
 
 
+def _catch_stop_signals(stop):
+    """
+    Call stop on SIGTERM or SIGINT, if running on the main thread
+
+    :returns: dict of the replaced handlers by signal number
+    """
+    handlers = {}
+    if current_thread() is main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handlers[signum] = signal.signal(
+                signum, lambda signum, frame: stop())
+    return handlers
+
+
+def _restore_signals(handlers):
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def _check_processor(processor):
+    """
+    Raise GatherException if the processor can only run under AsyncGather
+    """
+    import asyncio
+
+    if asyncio.iscoroutinefunction(processor.process_message_body):
+        raise GatherException(
+            'coroutine process_message_body requires AsyncGather')
+
+
+def _idle_backoff(backoff, settings):
+    """
+    :returns: seconds to idle after an empty receive, given the last
+        idle backoff
+    """
+    return min(max(backoff * 2, settings.get(
+        'IDLE_BACKOFF_MIN', Gather.DEFAULT_IDLE_BACKOFF_MIN)), settings.get(
+        'IDLE_BACKOFF_MAX', Gather.DEFAULT_IDLE_BACKOFF_MAX))
+
+
 class Gather(object):
     """
     Class to gather event messages from AWS SQS queue,
     validate and process their content
     """
 
+    DEFAULT_IDLE_BACKOFF_MIN = 1
+    DEFAULT_IDLE_BACKOFF_MAX = 60
+    MAX_VISIBILITY_TIMEOUT = 43200
+
     def __init__(self,
                  processor=None,
                  exception=None,
-                 sqs_settings=None):
+                 sqs_settings=None,
+                 metrics=None,
+                 sqs_client=None):
         """
         :param processor: A sub-class object of MessageBodyProcessor
+        :param metrics: optional Metrics object recording stage latencies
+        :param sqs_client: optional SQS client to share
         """
 
         if not processor:
             raise GatherException('missing event processor')
+        _check_processor(processor)
 
         self._processor = processor
         self._settings = sqs_settings if (
             sqs_settings) else self._processor.get_queue_settings()
 
-        self._queue = SQSQueue(self._settings)
+        self._queue = SQSQueue(self._settings, sqs_client=sqs_client)
         # if Exception, abort!
 
+        self._metrics = metrics if metrics else Metrics()
+        self._codec = get_codec(self._settings.get('JSON_CODEC'))
+
+        self._dedup = None
+        if self._settings.get('DEDUP', False):
+            self._dedup = MessageDedup(
+                maxsize=self._settings.get(
+                    'DEDUP_SIZE', MessageDedup.DEFAULT_SIZE),
+                ttl=self._settings.get('DEDUP_TTL', MessageDedup.DEFAULT_TTL),
+                use_memcached=self._settings.get('DEDUP_MEMCACHED', False))
+
+        self._max_receive_count = self._settings.get('MAX_RECEIVE_COUNT')
+        self._dead_letter = get_dead_letter_sink(self._settings)
+        if self._max_receive_count and self._dead_letter is None:
+            raise GatherException('MAX_RECEIVE_COUNT needs a '
+                                  'DEAD_LETTER_QUEUE or DEAD_LETTER_FILE')
+
+        self._process_executor = None
+        self._validate_executor = None
+        self._stopping = Event()
+        self._prefetcher = None
+        self._prefetched = None
+        self._prefetch_stopping = Event()
+
+    def run_forever(self, handle_signals=True):
+        """
+        Gather events until stop() is called or, when handling signals,
+        SIGTERM or SIGINT is received.  Either finishes the batch in hand
+        before returning.  Idle waits between empty receives double from
+        IDLE_BACKOFF_MIN up to IDLE_BACKOFF_MAX seconds.
+        """
+        handlers = _catch_stop_signals(self.stop) if handle_signals else {}
+
+        self._stopping.clear()
+        backoff = 0
+        try:
+            while not self._stopping.is_set():
+                if self.gather_events():
+                    backoff = 0
+                else:
+                    backoff = _idle_backoff(backoff, self._settings)
+                    logger.debug("GATHER: idle for {}s".format(backoff))
+                    self._stopping.wait(backoff)
+        finally:
+            _restore_signals(handlers)
+            self.close()
+
+    def stop(self):
+        """
+        Stop run_forever once the batch in hand is processed
+        """
+        logger.info("GATHER: stopping")
+        self._stopping.set()
+
+    def close(self):
+        """
+        Stop prefetching, making any prefetched messages visible again,
+        and release the processing threads and the signature validation
+        worker processes, if any
+        """
+        if self._prefetcher:
+            self._prefetch_stopping.set()
+            while self._prefetcher.is_alive() or (
+                    not self._prefetched.empty()):
+                try:
+                    messages, received_at, err = self._prefetched.get(
+                        timeout=0.1)
+                except Empty:
+                    continue
+                self._release(messages)
+                self._prefetched.task_done()
+            self._prefetcher = None
+
+        if self._process_executor:
+            self._process_executor.shutdown()
+            self._process_executor = None
+
+        if self._validate_executor:
+            self._validate_executor.shutdown()
+            self._validate_executor = None
+
     def gather_events(self):
-        messages = self._queue.get_messages()
+        """
+        Receive, process and delete one batch of messages
+
+        :returns: the number of messages received
+        """
+        with self._metrics.timer('receive'):
+            messages, received_at = self._receive()
+        started_at = time.time()
+
         logger.debug(
             "GATHER: event contains {} messages".format(len(messages)))
+        self._metrics.observe('batch_size', len(messages))
+        self._metrics.incr('received', len(messages))
 
-        for msg in messages:
+        heartbeat = None
+        if messages and self._settings.get('VISIBILITY_HEARTBEAT', False):
+            # keep messages hidden while they are being processed
+            heartbeat = VisibilityHeartbeat(
+                self._queue, self._queue.receive_setting('VISIBILITY_TIMEOUT'),
+                interval=self._settings.get('HEARTBEAT_INTERVAL'))
+            heartbeat.track(messages)
+            heartbeat.start()
+
+        try:
+            self._handle_messages(messages, received_at, heartbeat)
+        finally:
+            if heartbeat:
+                heartbeat.stop()
+
+        self._queue.record_batch(len(messages), time.time() - started_at)
+        return len(messages)
+
+    def _receive(self):
+        """
+        :returns: tuple of received messages and when they were received
+        """
+        if not self._settings.get('PREFETCH', False):
+            return self._queue.get_messages(), time.time()
+
+        if self._prefetcher is None:
+            self._prefetched = Queue(maxsize=1)
+            self._prefetch_stopping.clear()
+            self._prefetcher = Thread(target=self._prefetch, daemon=True)
+            self._prefetcher.start()
+
+        max_age = self._settings.get(
+            'PREFETCH_MAX_AGE',
+            self._queue.receive_setting('VISIBILITY_TIMEOUT') / 2)
+        while True:
+            messages, received_at, err = self._prefetched.get()
+            self._prefetched.task_done()
+            if err:
+                raise err
+
+            if not messages or time.time() - received_at <= max_age:
+                return messages, received_at
+
+            # too little visibility timeout left to process them
+            logger.warning("GATHER: releasing {} stale messages".format(
+                len(messages)))
+            self._metrics.incr('stale', len(messages))
+            self._release(messages)
+
+    def _prefetch(self):
+        """
+        Receive the next batch while the one before it is processed
+        """
+        while not self._prefetch_stopping.is_set():
             try:
-                # validate the message and hand it off for processing
-                json_body = json.loads(msg.body)
-                logger.debug("GATHER: JSON body: {}".format(json_body))
+                self._prefetched.put(
+                    (self._queue.get_messages(), time.time(), None))
+            except Exception as ex:
+                self._prefetched.put(([], time.time(), ex))
+
+            # receive again once the batch is taken
+            self._prefetched.join()
+
+    def _release(self, messages):
+        if messages:
+            self._queue.change_visibility(messages, 0)
+
+    def _handle_messages(self, messages, received_at, heartbeat=None):
+        loaded = [None] * len(messages)
+        if self._settings.get('BATCH_VALIDATE', False):
+            # verify the batch's signatures together before processing,
+            # bodies that do not parse fail where they are handled
+            def preload(msg):
+                try:
+                    return self._load_message(msg)
+                except ValueError:
+                    return None
 
-                message = Message(json_body, self._settings)
-                if message.validate():
-                    extracted_message = message.extract()
-                    logger.debug(
-                        "GATHER: processing {}".format(extracted_message))
+            loaded = [preload(msg) for msg in messages]
+            with self._metrics.timer('validate_batch'):
+                Message.validate_signatures(
+                    [message for message in loaded if message is not None],
+                    executor=self._get_validate_executor())
 
+        outcomes = self._process_messages(
+            messages, loaded, received_at, heartbeat)
+
+        # inform the queue which messages have been processed
+        processed = [msg for msg, (done, published_at) in zip(
+            messages, outcomes) if done]
+        self._metrics.incr('failed', len(messages) - len(processed))
+        processed.extend(self._handle_failures(
+            [msg for msg, (done, published_at) in zip(
+                messages, outcomes) if not done]))
+        if heartbeat:
+            # deleted receipt handles can no longer be extended
+            heartbeat.release(processed)
+        with self._metrics.timer('delete'):
+            not_deleted = self._queue.delete_messages(processed)
+        if not_deleted:
+            logger.error("GATHER: {} processed messages not deleted".format(
+                len(not_deleted)))
+
+        # publish-to-acknowledge lag
+        acked_at = time.time()
+        for msg, (done, published_at) in zip(messages, outcomes):
+            if done and published_at and msg not in not_deleted:
+                self._metrics.observe('ack_lag', acked_at - published_at)
+
+    def _process_messages(self, messages, loaded, received_at,
+                          heartbeat=None):
+        """
+        :returns: list of tuples of True for each message that can be
+            deleted, and its publish time
+        """
+        def process(msg, message):
+            done, published_at = self._handle_message(
+                msg, message, received_at)
+            if not done and heartbeat:
+                # failed messages become visible again on schedule
+                heartbeat.release([msg])
+            return done, published_at
+
+        workers = self._settings.get('PROCESS_WORKERS', 1)
+        if self._settings.get('PROCESS_BATCH', False):
+            outcomes = self._process_batch(messages, loaded, received_at)
+            if heartbeat:
+                heartbeat.release(
+                    [msg for msg, (done, published_at) in zip(
+                        messages, outcomes) if not done])
+        elif workers > 1 and len(messages) > 1:
+            # processor must be thread-safe to enable concurrent processing
+            outcomes = list(self._get_process_executor().map(
+                process, messages, loaded))
+        else:
+            outcomes = [process(msg, message)
+                        for msg, message in zip(messages, loaded)]
+
+        return outcomes
+
+    def _handle_message(self, msg, message, received_at):
+        """
+        Parse the message, unless parsed already, skip it if a duplicate
+        and otherwise process it
+
+        :returns: tuple of True if the message can be deleted, and its
+            publish time
+        """
+        message, published_at = self._receive_message(
+            msg, message, received_at)
+        if message is None:
+            return False, published_at
+
+        message_id = message.message_id() or msg.message_id
+        if self._is_duplicate(message_id):
+            return True, published_at
+
+        done = self._process_message(message)
+        if done and self._dedup:
+            self._dedup.record(message_id)
+        return done, published_at
+
+    def _receive_message(self, msg, message, received_at):
+        """
+        Parse the message, unless parsed already, and record its
+        publish-to-receive lag and delivery attempts
+
+        :returns: tuple of the Message, or None if the body does not
+            parse, and its publish time
+        """
+        receive_count = msg.attributes.get('ApproximateReceiveCount')
+        if receive_count:
+            self._metrics.observe('receive_count', int(receive_count))
+
+        if message is None:
+            try:
+                message = self._load_message(msg)
+            except ValueError as err:
+                logger.error("GATHER: cannot parse message {}: {}".format(
+                    msg.message_id, err))
+
+        published_at = (message.published_at() if message else None) or (
+            self._sent_at(msg))
+        if published_at:
+            self._metrics.observe('receive_lag', received_at - published_at)
+        return message, published_at
+
+    def _is_duplicate(self, message_id):
+        """
+        :returns: True if a delivery of the message was processed already
+        """
+        if self._dedup and self._dedup.seen(message_id):
+            self._metrics.incr('duplicate')
+            return True
+        return False
+
+    def _handle_failures(self, failed):
+        """
+        Divert failed messages received MAX_RECEIVE_COUNT times to the
+        dead letter sink, and with REDELIVERY_BACKOFF set, hide the rest
+        for twice as long after each receive
+
+        :returns: list of diverted messages, to be deleted
+        """
+        diverted = []
+        backoff = {}
+        for msg in failed:
+            receive_count = int(msg.attributes.get(
+                'ApproximateReceiveCount', 1))
+            if self._max_receive_count and (
+                    receive_count >= self._max_receive_count):
+                try:
+                    self._dead_letter.send(
+                        msg, 'processing failed {} times'.format(
+                            receive_count))
+                    diverted.append(msg)
+                    continue
+                except DeadLetterException as ex:
+                    logger.error("GATHER: {}".format(ex))
+
+            if self._settings.get('REDELIVERY_BACKOFF', False):
+                visibility_timeout = min(
+                    self._settings.get(
+                        'REDELIVERY_BACKOFF_BASE',
+                        self._queue.receive_setting('VISIBILITY_TIMEOUT')) *
+                    2 ** (receive_count - 1), self.MAX_VISIBILITY_TIMEOUT)
+                backoff.setdefault(visibility_timeout, []).append(msg)
+
+        for visibility_timeout, messages in backoff.items():
+            self._queue.change_visibility(messages, visibility_timeout)
+
+        if diverted:
+            logger.warning("GATHER: {} messages dead lettered".format(
+                len(diverted)))
+            self._metrics.incr('dead_lettered', len(diverted))
+        return diverted
+
+    @staticmethod
+    def _sent_at(msg):
+        sent_timestamp = msg.attributes.get('SentTimestamp')
+        if sent_timestamp:
+            return int(sent_timestamp) / 1000.0
+
+    def _get_process_executor(self):
+        if self._process_executor is None:
+            self._process_executor = ThreadPoolExecutor(
+                max_workers=self._settings.get('PROCESS_WORKERS'))
+        return self._process_executor
+
+    def _get_validate_executor(self):
+        workers = self._settings.get('VALIDATE_WORKERS', 0)
+        if workers and self._validate_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self._validate_executor = ProcessPoolExecutor(max_workers=workers)
+        return self._validate_executor
+
+    def _load_message(self, msg):
+        with self._metrics.timer('parse'):
+            json_body = self._codec.loads(msg.body)
+        logger.debug("GATHER: JSON body: {}".format(json_body))
+        return Message(json_body, self._settings)
+
+    def _extract_message(self, message):
+        """
+        Validate and extract the message payload
+
+        :returns: tuple of validity and the extracted payload
+        """
+        with self._metrics.timer('validate'):
+            valid = message.validate()
+
+        if not valid:
+            logger.debug("GATHER: Message validation failure")
+            self._metrics.incr('invalid')
+            return False, None
+
+        with self._metrics.timer('extract'):
+            return True, message.extract()
+
+    def _process_message(self, message):
+        """
+        Validate the message and hand it off for processing
+
+        :returns: True if the message can be deleted from the queue
+        """
+        try:
+            valid, extracted_message = self._extract_message(message)
+            if valid:
+                logger.debug(
+                    "GATHER: processing {}".format(extracted_message))
+
+                with self._metrics.timer('process'):
                     self._processor.process(extracted_message)
-                else:
-                    logger.debug("GATHER: Message validation failure")
+
+        except (CryptoException, ProcessorException) as err:
+            self._log_error(err)
+            return False
+
+        return True
+
+    def _process_batch(self, messages, loaded, received_at):
+        """
+        Parse and validate the messages and hand their payloads off for
+        processing together
+
+        :returns: list of tuples of True for each message that can be
+            deleted, and its publish time
+        """
+        results = [True] * len(messages)
+        published = []
+        message_ids = {}
+        indexes = []
+        payloads = []
+        for i, (msg, message) in enumerate(zip(messages, loaded)):
+            message, published_at = self._receive_message(
+                msg, message, received_at)
+            published.append(published_at)
+            if message is None:
+                results[i] = False
+                continue
+
+            message_id = message.message_id() or msg.message_id
+            if self._is_duplicate(message_id):
+                continue
+
+            message_ids[i] = message_id
+            try:
+                valid, extracted_message = self._extract_message(message)
+                if valid:
+                    indexes.append(i)
+                    payloads.append(extracted_message)
 
             except (CryptoException, ProcessorException) as err:
-                # log message specific error, abort if unknown error
-                logger.error('{}: {}'.format(
-                    err, traceback.format_exc().splitlines()))
+                self._log_error(err)
+                results[i] = False
+
+        logger.debug("GATHER: processing batch of {}".format(len(payloads)))
+        try:
+            with self._metrics.timer('process_batch'):
+                failed = self._processor.process_batch(payloads)
+
+        except (CryptoException, ProcessorException) as err:
+            # e.g. the batch's transaction failed, leave all of it queued
+            self._log_error(err)
+            failed = range(len(payloads))
+
+        if any(not 0 <= n < len(payloads) for n in failed):
+            logger.error("GATHER: process_batch returned invalid "
+                         "indexes {}".format(list(failed)))
+            failed = range(len(payloads))
+
+        for n in failed:
+            results[indexes[n]] = False
+
+        if self._dedup:
+            for i, message_id in message_ids.items():
+                if results[i]:
+                    self._dedup.record(message_id)
+
+        return list(zip(results, published))
+
+    @staticmethod
+    def _log_error(err):
+        # log message specific error, abort if unknown error
+        logger.error('{}: {}'.format(
+            err, traceback.format_exc().splitlines()))
+
+
+class MultiGather(object):
+    """
+    Class to gather event messages from several AWS SQS queues in one
+    process, each with its own processor, sharing a pool of threads
+    and the SQS connections among them
+    """
+
+    def __init__(self, processors, max_workers=None, metrics=None):
+        """
+        :param processors: list of MessageBodyProcessor sub-class objects,
+            one per AWS_SQS settings entry to gather from
+        :param max_workers: number of queues gathered from at once,
+            default all of them
+        :param metrics: optional Metrics object shared by the queues
+        """
+        if not processors:
+            raise GatherException('missing event processors')
+        for processor in processors:
+            _check_processor(processor)
+
+        self._gatherers = [Gather(processor=processor, metrics=metrics)
+                           for processor in processors]
+        self._max_workers = max_workers if (
+            max_workers) else len(self._gatherers)
+
+        # queues with the same credentials and region share a client
+        for gatherer in self._gatherers:
+            queue = gatherer._queue
+            queue.sqs_client = sqs_client(
+                queue.key_id, queue.key, queue.region,
+                max_pool_connections=max(
+                    SQSQueue.DEFAULT_POOL_CONNECTIONS, self._max_workers))
+
+        self._weights = [max(int(gatherer._settings.get('WEIGHT', 1)), 1)
+                         for gatherer in self._gatherers]
+        self._current = [0] * len(self._gatherers)
+        self._backoff = [0] * len(self._gatherers)
+        self._ready_at = [0] * len(self._gatherers)
+        self._executor = None
+        self._stopping = Event()
+
+    def run_forever(self, handle_signals=True):
+        """
+        Gather events from every queue until stop() is called or, when
+        handling signals, SIGTERM or SIGINT is received.  Each queue is
+        gathered from by at most one thread at a time, and free threads
+        go to ready queues in proportion to their WEIGHT settings.  A
+        queue idles after an empty receive as it would under Gather.
+        """
+        handlers = _catch_stop_signals(self.stop) if handle_signals else {}
+
+        self._stopping.clear()
+        executor = self._get_executor()
+        running = {}
+        try:
+            while not self._stopping.is_set():
+                now = time.monotonic()
+                for i in self._schedule(now, running.values()):
+                    running[executor.submit(
+                        self._gatherers[i].gather_events)] = i
+
+                # with every thread busy, only a finished batch can free
+                # one for a ready queue
+                idle = [self._ready_at[i] - now
+                        for i in range(len(self._gatherers))
+                        if i not in running.values() and (
+                            self._ready_at[i] > now)]
+                timeout = min(idle) if idle and (
+                    len(running) < self._max_workers) else None
+                if not running:
+                    self._stopping.wait(timeout)
+                    continue
+
+                done, _ = wait(running, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._gathered(running.pop(future), future.result())
+        finally:
+            _restore_signals(handlers)
+            self.close()
+
+    def stop(self):
+        """
+        Stop run_forever once the batches in hand are processed
+        """
+        logger.info("GATHER: stopping")
+        self._stopping.set()
+
+    def close(self):
+        """
+        Wait for the batches in hand and release the threads and the
+        signature validation worker processes, if any
+        """
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+        for gatherer in self._gatherers:
+            gatherer.close()
+
+    def gather_events(self):
+        """
+        Receive, process and delete one batch of messages from each queue
+
+        :returns: the number of messages received
+        """
+        return sum(self._get_executor().map(
+            lambda gatherer: gatherer.gather_events(), self._gatherers))
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers)
+        return self._executor
+
+    def _schedule(self, now, running):
+        """
+        Smooth weighted round-robin over the queues that are neither
+        running nor idling
+
+        :returns: list of queue indexes to gather from now
+        """
+        running = set(running)
+        ready = [i for i in range(len(self._gatherers))
+                 if i not in running and self._ready_at[i] <= now]
+        scheduled = []
+        while ready and len(running) + len(scheduled) < self._max_workers:
+            total = sum(self._weights[i] for i in ready)
+            for i in ready:
+                self._current[i] += self._weights[i]
+            i = max(ready, key=lambda i: self._current[i])
+            self._current[i] -= total
+            ready.remove(i)
+            scheduled.append(i)
+
+        return scheduled
 
-            else:
-                # inform the queue that this message has been processed
-                msg.delete()
+    def _gathered(self, i, received):
+        if received:
+            self._backoff[i] = 0
+            self._ready_at[i] = 0
+        else:
+            self._backoff[i] = _idle_backoff(
+                self._backoff[i], self._gatherers[i]._settings)
+            self._ready_at[i] = time.monotonic() + self._backoff[i]
+            logger.debug("GATHER: {} idle for {}s".format(
+                self._gatherers[i]._queue.queue_name, self._backoff[i]))
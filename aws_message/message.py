@@ -1,14 +1,18 @@
 # Copyright 2024 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
-from aws_message.crypto import Signature, CryptoException
+from aws_message.crypto import (
+    Signature, CryptoException, validate_signatures)
+from aws_message.codec import get_codec
 from base64 import b64decode
-import json
+from binascii import Error as Base64Error
+from datetime import datetime, timezone
 import re
 
-re_base64 = re.compile(
-    r'^(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|'
-    r'[A-Za-z0-9+/]{3}=)?$')
+# characters that may begin JSON text, none of which begin base64 text
+re_json_start = re.compile(r'\s*[{\["\-0-9tfn]')
+re_json_start_bytes = re.compile(rb'\s*[{\["\-0-9tfn]')
+JSON_ONLY_START = frozenset('{["-') | frozenset(' \t\r\n')
 
 
 class Message(object):
@@ -16,6 +20,44 @@ class Message(object):
         self._message = message
         self._settings = settings
         self._is_sns = (isinstance(message, dict) and 'TopicArn' in message)
+        self._codec = get_codec(settings.get('JSON_CODEC'))
+        self._signature_checked = False
+        self._signature_error = None
+
+    @staticmethod
+    def validate_signatures(messages, executor=None):
+        """
+        Verify the SNS signatures of a batch of messages in one pass,
+        resolving each signing certificate once.  The outcome for each
+        message is reported by its validate().
+
+        :param messages: list of Message objects
+        :param executor: optional concurrent.futures executor on which
+            to run the signature verifications
+        """
+        batch = []
+        signed = []
+        for message in messages:
+            if not (message._is_sns and message._settings.get(
+                    'VALIDATE_SNS_SIGNATURE', True) and
+                    message._validate_topic_arn()):
+                continue
+
+            try:
+                if message._message['SignatureVersion'] != '1':
+                    continue
+
+                signed.append((message._message['SigningCertURL'],
+                               message._sign_text(message._message),
+                               b64decode(message._message['Signature'])))
+                batch.append(message)
+            except (KeyError, ValueError):
+                # left for validate() to report
+                continue
+
+        for message, err in zip(batch, validate_signatures(signed, executor)):
+            message._signature_checked = True
+            message._signature_error = err
 
     def validate(self):
         valid = True
@@ -36,14 +78,63 @@ class Message(object):
         if not isinstance(message, str):
             return message
 
-        if re_base64.match(message):
-            message = b64decode(message)
+        decoded = self._decode_base64(message)
+        if decoded is not None:
+            message = decoded
+            if not re_json_start_bytes.match(message):
+                return message
+        elif not re_json_start.match(message):
+            return message
 
         try:
-            return json.loads(message)
-        except json.decoder.JSONDecodeError:
+            return self._codec.loads(message)
+        except ValueError:
             return message
 
+    @staticmethod
+    def _decode_base64(message):
+        """
+        :returns: the decoded bytes if message is base64 text, else None
+        """
+        if message[-1:] == '\n':
+            message = message[:-1]
+
+        # b64decode raises ValueError rather than binascii.Error for
+        # non-ASCII text, which cannot be base64 anyway
+        if len(message) % 4 or message[:1] in JSON_ONLY_START or (
+                not message.isascii()):
+            return None
+
+        try:
+            decoded = b64decode(message, validate=True)
+        except Base64Error:
+            return None
+
+        # padding is only valid at the end
+        if '=' in message[:-2]:
+            return None
+
+        return decoded
+
+    def message_id(self):
+        """
+        :returns: SNS MessageId, or None
+        """
+        if self._is_sns:
+            return self._message.get('MessageId')
+
+    def published_at(self):
+        """
+        :returns: SNS publish time in seconds since the epoch, or None
+        """
+        if self._is_sns and self._message.get('Timestamp'):
+            try:
+                return datetime.strptime(
+                    self._message['Timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ'
+                ).replace(tzinfo=timezone.utc).timestamp()
+            except ValueError:
+                pass
+
     def _validate_topic_arn(self):
         if (self._settings.get('TOPIC_ARN') and
                 self._message['TopicArn'] != self._settings['TOPIC_ARN']):
@@ -55,6 +146,11 @@ class Message(object):
             raise CryptoException('Unknown SNS Signature Version: {}'.format(
                 self._message['SignatureVersion']))
 
+        if self._signature_checked:
+            if self._signature_error is not None:
+                raise CryptoException(str(self._signature_error))
+            return
+
         sig_conf = {
             'cert': {
                 'type': 'url',
@@ -0,0 +1,119 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+
+class Metrics(object):
+    """
+    Gather pipeline instrumentation hook that discards its measurements.
+    Sub-class to forward them to a metrics backend.
+    """
+
+    def timing(self, name, seconds):
+        """
+        Record the latency of one pass through the named stage
+        """
+        pass
+
+    def observe(self, name, value):
+        """
+        Record a sample of the named value, e.g. a batch size
+        """
+        pass
+
+    def incr(self, name, count=1):
+        """
+        Increment the named counter
+        """
+        pass
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, perf_counter() - start)
+
+
+class InMemoryMetrics(Metrics):
+    """
+    Aggregates counters, and keeps the most recent max_samples samples
+    of each timing and value for percentile queries
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = defaultdict(int)
+            self._totals = defaultdict(lambda: [0, 0.0])
+            self._samples = defaultdict(
+                lambda: deque(maxlen=self.max_samples))
+
+    def timing(self, name, seconds):
+        self.observe(name, seconds)
+
+    def observe(self, name, value):
+        with self._lock:
+            self._samples[name].append(value)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += value
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def percentile(self, name, percent):
+        """
+        :returns: the percent percentile of the recent samples of name,
+            or None if there are none
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        return self._percentile(samples, percent)
+
+    def summary(self, percents=(50, 90, 99)):
+        """
+        :returns: dict of counters, and of count, mean, min, max and
+            percentiles for each timing and value
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            stats = {}
+            for name, samples in self._samples.items():
+                ordered = sorted(samples)
+                count, total = self._totals[name]
+                stats[name] = {
+                    'count': count,
+                    'mean': total / count if count else None,
+                    'min': ordered[0] if ordered else None,
+                    'max': ordered[-1] if ordered else None,
+                }
+                for percent in percents:
+                    stats[name]['p{}'.format(percent)] = self._percentile(
+                        ordered, percent)
+
+        return {'counters': counters, 'stats': stats}
+
+    @staticmethod
+    def _percentile(ordered, percent):
+        if not ordered:
+            return None
+        index = int(round((percent / 100.0) * (len(ordered) - 1)))
+        return ordered[index]
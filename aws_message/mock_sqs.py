@@ -1,17 +1,19 @@
 # Copyright 2024 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import deque
+from heapq import heappush, heappop
 from importlib import import_module
-from hashlib import sha1
+from itertools import count
 from http.client import HTTPSConnection
+from threading import RLock
+from botocore.exceptions import ClientError
 from commonconf import settings
 import socket
 import ssl
 import os
-import sys
-import inspect
 import glob
-import re
+import time
 
 
 class HTTPSConnectionValidating(HTTPSConnection):
@@ -41,69 +43,270 @@ def https_connection_factory(host, port=None, strict=None):
                                      cert_file=settings.EVENT_AWS_SQS_CERT)
 
 
+class MockMessage(object):
+    """
+    Received message, after boto3's sqs.Message
+    """
+
+    def __init__(self, queue, message_id, body, receipt_handle,
+                 attributes, message_attributes):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.attributes = attributes
+        self.message_attributes = message_attributes
+
+    def delete(self):
+        self.queue.delete_message(self)
+
+    def change_visibility(self, VisibilityTimeout):
+        self.queue.change_message_visibility_batch(Entries=[{
+            'Id': '0', 'ReceiptHandle': self.receipt_handle,
+            'VisibilityTimeout': VisibilityTimeout}])
+
+
 class SQSQueueMock(object):
+    """
+    In-memory SQS queue engine exposing the subset of boto3's sqs.Queue
+    used by SQSQueue: receive, batch delete and visibility changes with
+    visibility timeouts, receive counts and FIFO message groups.  Sends,
+    receives and deletes are O(1) per message.
+
+    Long polls do not wait.  Use it in place of the boto3 queue, e.g.
+        sqs_queue._queue = SQSQueueMock(settings=sqs_settings)
+    """
+
+    DEFAULT_VISIBILITY_TIMEOUT = 30
+
     def __init__(self, *args, **kwargs):
-        self._settings = kwargs.get('settings')
-        self._fs_encoding = sys.getfilesystemencoding() or \
-            sys.getdefaultencoding()
-        self._app_mock_dirs = []
-        self._seen_messages = []
-        try:
-            for app in settings.INSTALLED_APPS:
-                mod = import_module(app)
-                mock_dir = os.path.join(
-                    os.path.dirname(mod.__file__), 'mock')
-                if os.path.isdir(mock_dir):
-                    data = {
-                        'base': os.path.dirname(
-                            mod.__file__).decode(self._fs_encoding),
-                        'path': mock_dir.decode(self._fs_encoding),
-                        'app': app,
-                    }
-                    self._app_mock_dirs.append(data)
-        except Exception:
-            pass
-
-    def get_messages(self, max_msgs_to_fetch):
-        try:
-            module = self._calling_module()
-            mock_dir = self._mock_dir(module)
-            msg_files = glob.glob(os.path.join(mock_dir, 'message*'))
-            for msg_file in msg_files:
+        """
+        :param settings: optional queue settings whose QUEUE names the
+            mock/aws_message/<QUEUE> directory of message files to seed
+            the queue from
+        :param fifo: deliver each MessageGroupId in order, one group
+            batch in flight at a time
+        :param clock: monotonic time source, for tests
+        """
+        self._settings = kwargs.get('settings') or {}
+        self.fifo = kwargs.get('fifo', False)
+        self._clock = kwargs.get('clock', time.monotonic)
+        self._messages = {}
+        self._in_flight = {}
+        self._expiry = []
+        self._ready = deque()
+        self._groups = {}
+        self._group_in_flight = {}
+        self._ids = count()
+        self._handles = count()
+        self._lock = RLock()
+
+        if self._settings.get('QUEUE'):
+            for msg_file in self._mock_files(self._settings['QUEUE']):
                 with open(msg_file, 'r') as handle:
-                    msg = handle.read()
-                    if self._hash(msg) not in self._seen_messages:
-                        return [RawMessage(body=msg)]
-        except Exception:
-            pass
+                    self.send_message(MessageBody=handle.read())
+
+    @property
+    def attributes(self):
+        with self._lock:
+            self._expire()
+            return {
+                'ApproximateNumberOfMessages': str(
+                    len(self._messages) - len(self._in_flight)),
+                'ApproximateNumberOfMessagesNotVisible': str(
+                    len(self._in_flight)),
+            }
 
-        return []
+    def load(self):
+        pass
 
-    def _hash(self, raw):
-        return sha1(raw).hexdigest()
+    reload = load
+
+    def send_message(self, MessageBody, MessageGroupId=None,
+                     MessageAttributes=None, **kwargs):
+        if self.fifo and MessageGroupId is None:
+            raise ClientError({'Error': {
+                'Code': 'MissingParameter',
+                'Message': 'The request must contain the parameter '
+                           'MessageGroupId.'}}, 'SendMessage')
+
+        with self._lock:
+            message_id = str(next(self._ids))
+            self._messages[message_id] = {
+                'body': MessageBody,
+                'group': MessageGroupId,
+                'receive_count': 0,
+                'sent': str(int(time.time() * 1000)),
+                'message_attributes': MessageAttributes or {},
+            }
+            self._enqueue(message_id)
+        return {'MessageId': message_id}
+
+    def send_messages(self, Entries):
+        return {'Successful': [
+            dict(self.send_message(**{
+                k: v for k, v in entry.items() if k != 'Id'}), Id=entry['Id'])
+            for entry in Entries]}
+
+    def receive_messages(self, MaxNumberOfMessages=1, VisibilityTimeout=None,
+                         **kwargs):
+        if VisibilityTimeout is None:
+            VisibilityTimeout = self.DEFAULT_VISIBILITY_TIMEOUT
+
+        received = []
+        with self._lock:
+            self._expire()
+            while len(received) < MaxNumberOfMessages and self._ready:
+                if not self.fifo:
+                    received.append(self._receive(
+                        self._ready.popleft(), VisibilityTimeout))
+                    continue
+
+                # a group's messages are delivered in order, and the group
+                # is not delivered from again until none are in flight
+                group = self._ready.popleft()
+                messages = self._groups[group]
+                while messages and len(received) < MaxNumberOfMessages:
+                    received.append(self._receive(
+                        messages.popleft(), VisibilityTimeout))
+                if not messages:
+                    del self._groups[group]
+
+        return received
+
+    def get_messages(self, max_msgs_to_fetch=10):
+        return self.receive_messages(MaxNumberOfMessages=max_msgs_to_fetch)
 
     def delete_message(self, msg):
-        hash = self._hash(msg.get_body())
-        if hash not in self._seen_messages:
-            self._seen_messages.append(hash)
-
-    def _calling_module(self):
-        sqs_dir = os.path.dirname(__file__)
-        for frame in inspect.stack():
-            mod = inspect.getmodule(frame[0])
-            if not mod.__file__.startswith(sqs_dir):
-                return mod
-
-        raise Exception("no calling module")
-
-    def _mock_dir(self, module):
-        dir = os.path.dirname(module.__file__)
-        for mock_dir in self._app_mock_dirs:
-            if dir.startswith(mock_dir['base']):
-                msg_dir = os.path.join(mock_dir['path'],
-                                       'aws_message',
-                                       self._settings.get('QUEUE'))
-                if os.path.isdir(msg_dir):
-                    return msg_dir
-
-        raise Exception("no mock directory")
+        with self._lock:
+            deleted = self._delete(msg.receipt_handle)
+        if not deleted:
+            raise ClientError({'Error': {
+                'Code': 'ReceiptHandleIsInvalid',
+                'Message': 'The receipt handle {} is not valid.'.format(
+                    msg.receipt_handle)}}, 'DeleteMessage')
+
+    def delete_messages(self, Entries):
+        with self._lock:
+            results = [self._delete(e['ReceiptHandle']) for e in Entries]
+        return self._batch_result(Entries, results)
+
+    def change_message_visibility_batch(self, Entries):
+        results = []
+        with self._lock:
+            self._expire()
+            for entry in Entries:
+                in_flight = self._in_flight.get(entry['ReceiptHandle'])
+                if in_flight is not None:
+                    self._hide(entry['ReceiptHandle'], in_flight[0],
+                               entry['VisibilityTimeout'])
+                results.append(in_flight is not None)
+
+        return self._batch_result(Entries, results)
+
+    def _receive(self, message_id, visibility_timeout):
+        message = self._messages[message_id]
+        message['receive_count'] += 1
+        message.setdefault('first_receive', str(int(time.time() * 1000)))
+
+        receipt_handle = '{}-{}'.format(message_id, next(self._handles))
+        self._hide(receipt_handle, message_id, visibility_timeout)
+        if self.fifo and message['group'] is not None:
+            self._group_in_flight[message['group']] = (
+                self._group_in_flight.get(message['group'], 0) + 1)
+
+        attributes = {
+            'SentTimestamp': message['sent'],
+            'ApproximateReceiveCount': str(message['receive_count']),
+            'ApproximateFirstReceiveTimestamp': message['first_receive'],
+        }
+        if message['group'] is not None:
+            attributes['MessageGroupId'] = message['group']
+
+        return MockMessage(self, message_id, message['body'], receipt_handle,
+                           attributes, message['message_attributes'])
+
+    def _hide(self, receipt_handle, message_id, visibility_timeout):
+        visible_at = self._clock() + visibility_timeout
+        self._in_flight[receipt_handle] = (message_id, visible_at)
+        heappush(self._expiry, (visible_at, receipt_handle))
+
+    def _delete(self, receipt_handle):
+        self._expire()
+        in_flight = self._in_flight.pop(receipt_handle, None)
+        if in_flight is None:
+            return False
+
+        message = self._messages.pop(in_flight[0])
+        self._release_group(message['group'])
+        return True
+
+    def _expire(self):
+        """
+        Return messages whose visibility timeout has lapsed to the queue
+        """
+        now = self._clock()
+        while self._expiry and self._expiry[0][0] <= now:
+            visible_at, receipt_handle = heappop(self._expiry)
+            in_flight = self._in_flight.get(receipt_handle)
+            if in_flight is None or in_flight[1] != visible_at:
+                # deleted, or its visibility was since changed
+                continue
+
+            del self._in_flight[receipt_handle]
+            self._enqueue(in_flight[0], redelivery=True)
+            self._release_group(self._messages[in_flight[0]]['group'])
+
+    def _enqueue(self, message_id, redelivery=False):
+        group = self._messages[message_id]['group']
+        if not self.fifo or group is None:
+            if redelivery:
+                self._ready.appendleft(message_id)
+            else:
+                self._ready.append(message_id)
+            return
+
+        messages = self._groups.setdefault(group, deque())
+        if redelivery:
+            messages.appendleft(message_id)
+        else:
+            messages.append(message_id)
+
+        if len(messages) == 1 and not self._group_in_flight.get(group):
+            self._ready.append(group)
+
+    def _release_group(self, group):
+        if not self.fifo or group is None:
+            return
+
+        self._group_in_flight[group] -= 1
+        if not self._group_in_flight[group]:
+            del self._group_in_flight[group]
+            if group in self._groups:
+                self._ready.append(group)
+
+    @staticmethod
+    def _batch_result(entries, results):
+        return {
+            'Successful': [{'Id': e['Id']} for e, ok in zip(
+                entries, results) if ok],
+            'Failed': [{'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid',
+                        'SenderFault': True} for e, ok in zip(
+                entries, results) if not ok],
+        }
+
+    @staticmethod
+    def _mock_files(queue_name):
+        msg_files = []
+        for app in getattr(settings, 'INSTALLED_APPS', None) or []:
+            try:
+                mod = import_module(app)
+            except ImportError:
+                continue
+
+            msg_dir = os.path.join(os.path.dirname(mod.__file__), 'mock',
+                                   'aws_message', queue_name)
+            msg_files.extend(sorted(glob.glob(
+                os.path.join(msg_dir, 'message*'))))
+
+        return msg_files
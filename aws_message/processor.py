@@ -2,8 +2,10 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import logging
+import traceback
 from abc import ABC, abstractmethod
 from commonconf import settings
+from aws_message.crypto import CryptoException
 
 
 class ProcessorException(Exception):
@@ -44,20 +46,64 @@ class MessageBodyProcessor(ABC):
         :param payload: the message payload json data
         """
         if self.validate_message_body(payload):
+            self.process_message_body(self.prepare_message_body(payload))
 
-            if self.settings.get('VALIDATE_BODY_SIGNATURE', False):
-                self.validate_message_body_signature(payload)
+    def process_batch(self, payloads):
+        """
+        Process the payloads gathered in one receive.  Override in the
+        sub-class to handle them together, e.g. in a single transaction.
+
+        :param payloads: list of message payload json data
+        :returns: list of indexes of the payloads that failed processing,
+            whose messages are left on the queue
+        """
+        failed = []
+        for i, payload in enumerate(payloads):
+            try:
+                self.process(payload)
+            except (CryptoException, ProcessorException) as err:
+                self.logger.error('{}: {}'.format(
+                    err, traceback.format_exc().splitlines()))
+                failed.append(i)
+
+        return failed
 
-            if self.is_encrypted:
-                # the payload is encrypted
-                payload = self.decrypt_message_body(payload)
+    async def process_async(self, payload):
+        """
+        Coroutine counterpart of process().  process_message_body may be
+        defined as a coroutine, otherwise it is run in the event loop's
+        default executor.
+
+        :param payload: the message payload json data
+        """
+        import asyncio
 
-            self.process_message_body(payload)
+        if self.validate_message_body(payload):
+            payload = self.prepare_message_body(payload)
+            if asyncio.iscoroutinefunction(self.process_message_body):
+                await self.process_message_body(payload)
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.process_message_body, payload)
+
+    def prepare_message_body(self, payload):
+        """
+        Validate the payload signature and decrypt the payload as configured
+        """
+        if self.settings.get('VALIDATE_BODY_SIGNATURE', False):
+            self.validate_message_body_signature(payload)
+
+        if self.is_encrypted:
+            # the payload is encrypted
+            payload = self.decrypt_message_body(payload)
+
+        return payload
 
     @abstractmethod
     def process_message_body(self, payload):
         """
-        A sub-class must define this method
+        A sub-class must define this method, optionally as a coroutine
+        for use with AsyncGather only
         :raises ProcessorException: any error unable to handle
         """
         pass
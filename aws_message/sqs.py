@@ -1,22 +1,129 @@
 # Copyright 2024 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+from concurrent.futures import (
+    ThreadPoolExecutor, wait, FIRST_COMPLETED)
+from logging import getLogger
+from threading import Event, Lock, Thread
+import math
 import re
+import time
+
+
+logger = getLogger(__name__)
 
 
 class SQSException(Exception):
     pass
 
 
+# low-level clients shared process-wide, keyed by credentials, region
+# and connection pool size
+_clients = {}
+_clients_lock = Lock()
+
+
+def sqs_client(key_id, key, region, max_pool_connections=None):
+    """
+    SQS client, and so connection pool, shared by queues with the same
+    credentials, region and pool size
+    """
+    cache_key = (key_id, key, region, max_pool_connections)
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            # boto3 is imported on first use, it is slow to load
+            from botocore.config import Config
+            import boto3
+
+            config = None
+            if max_pool_connections:
+                config = Config(max_pool_connections=max_pool_connections)
+
+            client = boto3.client(
+                'sqs',
+                aws_access_key_id=key_id,
+                aws_secret_access_key=key,
+                region_name=region,
+                config=config
+            )
+            _clients[cache_key] = client
+        return client
+
+
+class ClientMessage(object):
+    """
+    Received message, after boto3's sqs.Message
+    """
+
+    def __init__(self, queue, message):
+        self.queue = queue
+        self.message_id = message.get('MessageId')
+        self.body = message.get('Body')
+        self.receipt_handle = message.get('ReceiptHandle')
+        self.attributes = message.get('Attributes', {})
+        self.message_attributes = message.get('MessageAttributes', {})
+
+    def delete(self):
+        self.queue.delete_message(self)
+
+
+class ClientQueue(object):
+    """
+    SQS queue, after boto3's sqs.Queue, on a shared low-level client
+    """
+
+    def __init__(self, client, url):
+        self.client = client
+        self.url = url
+
+    @property
+    def attributes(self):
+        return self.client.get_queue_attributes(
+            QueueUrl=self.url, AttributeNames=['All'])['Attributes']
+
+    def load(self):
+        pass
+
+    reload = load
+
+    def receive_messages(self, **kwargs):
+        response = self.client.receive_message(QueueUrl=self.url, **kwargs)
+        return [ClientMessage(self, message)
+                for message in response.get('Messages', [])]
+
+    def send_message(self, **kwargs):
+        return self.client.send_message(QueueUrl=self.url, **kwargs)
+
+    def delete_message(self, msg):
+        return self.client.delete_message(
+            QueueUrl=self.url, ReceiptHandle=msg.receipt_handle)
+
+    def delete_messages(self, Entries):
+        return self.client.delete_message_batch(
+            QueueUrl=self.url, Entries=Entries)
+
+    def change_message_visibility_batch(self, Entries):
+        return self.client.change_message_visibility_batch(
+            QueueUrl=self.url, Entries=Entries)
+
+
 class SQSQueue(object):
 
     DEFAULT_WAIT_TIME = 10
     DEFAULT_VISIBILITY_TIMEOUT = 10
     DEFAULT_MESSAGE_GATHER_SIZE = 10
     DEFAULT_POLL_COUNT = 1
+    DEFAULT_POOL_CONNECTIONS = 10
+    BATCH_SIZE = 10
 
-    def __init__(self, sqs_settings):
+    def __init__(self, sqs_settings, sqs_client=None):
+        """
+        :param sqs_settings: one AWS_SQS settings entry
+        :param sqs_client: optional SQS client to use instead of the
+            shared one for the queue's credentials and region
+        """
+        self.sqs_client = sqs_client
         try:
             self._settings = sqs_settings
             self.arn = self._settings.get('QUEUE_ARN')
@@ -41,39 +148,345 @@ class SQSQueue(object):
         self.region = m.group('region')
         self.account_id = m.group('account_id')
         self.queue_name = m.group('queue_name')
+        self.url = 'https://sqs.{}.amazonaws.com/{}/{}'.format(
+            self.region, self.account_id, self.queue_name)
+
+        self._tuner = None
+        if self._settings.get('ADAPTIVE_RECEIVE', False):
+            self._tuner = ReceiveTuner(self)
 
     def __getattr__(self, attr):
         if attr == '_queue':
-            sqs = boto3.resource(
-                'sqs',
-                aws_access_key_id=self.key_id,
-                aws_secret_access_key=self.key,
-                region_name=self.region
-            )
+            client = self.sqs_client
+            if client is None:
+                client = sqs_client(
+                    self.key_id, self.key, self.region,
+                    max_pool_connections=self._settings.get(
+                        'MAX_POOL_CONNECTIONS'))
 
-            self._queue = sqs.get_queue_by_name(QueueName=self.queue_name)
-            if self._queue is None:
-                raise SQSException('No queue by name {}'.format(
-                    self.queue_name))
+            self._queue = ClientQueue(client, self.url)
             return self._queue
         raise AttributeError(attr)
 
+    def receive_setting(self, name):
+        """
+        :param name: 'POLL_COUNT', 'WAIT_TIME', 'VISIBILITY_TIMEOUT' or
+            'MESSAGE_GATHER_SIZE'
+        :returns: the value in effect, as tuned when ADAPTIVE_RECEIVE is set
+        """
+        if self._tuner and name in self._tuner.values:
+            return self._tuner.values[name]
+        return self._settings.get(
+            name, getattr(self, 'DEFAULT_{}'.format(name)))
+
+    def record_batch(self, count, seconds):
+        """
+        Report that count received messages took seconds to process
+        """
+        if self._tuner:
+            self._tuner.record(count, seconds)
+
     def get_messages(self):
+        if self._tuner:
+            self._tuner.sample()
+
+        poll_count = self.receive_setting('POLL_COUNT')
+        receivers = min(self._settings.get('RECEIVE_WORKERS', 1), poll_count)
+        if receivers > 1:
+            return self._get_messages_parallel(poll_count, receivers)
+
         ret_messages = []
-        poll_count = self._settings.get('POLL_COUNT', self.DEFAULT_POLL_COUNT)
         for i in range(poll_count):
-            messages = self._queue.receive_messages(
-                AttributeNames=['All'],
-                MessageAttributeNames=['All'],
-                MaxNumberOfMessages=self._settings.get(
-                    'MESSAGE_GATHER_SIZE', self.DEFAULT_MESSAGE_GATHER_SIZE),
-                WaitTimeSeconds=self._settings.get(
-                    'WAIT_TIME', self.DEFAULT_WAIT_TIME),
-                VisibilityTimeout=self._settings.get(
-                    'VISIBILITY_TIMEOUT', self.DEFAULT_VISIBILITY_TIMEOUT))
-
+            messages = self._receive_messages(self._queue)
             ret_messages.extend(messages)
             if not len(messages):
                 break
 
         return ret_messages
+
+    def _get_messages_parallel(self, poll_count, receivers):
+        """
+        Keep up to receivers long polls in flight, starting another as
+        each one returns until poll_count receives have been made or a
+        receive comes back empty.
+        """
+        ret_messages = []
+        queue = self._queue
+        with ThreadPoolExecutor(max_workers=receivers) as executor:
+            pending = set(executor.submit(self._receive_messages, queue)
+                          for i in range(receivers))
+            polled = receivers
+            drained = False
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    messages = future.result()
+                    ret_messages.extend(messages)
+                    if not len(messages):
+                        drained = True
+                    elif not drained and polled < poll_count:
+                        pending.add(executor.submit(
+                            self._receive_messages, queue))
+                        polled += 1
+
+        return ret_messages
+
+    def _receive_messages(self, queue):
+        return queue.receive_messages(
+            AttributeNames=['All'],
+            MessageAttributeNames=['All'],
+            MaxNumberOfMessages=self.receive_setting('MESSAGE_GATHER_SIZE'),
+            WaitTimeSeconds=self.receive_setting('WAIT_TIME'),
+            VisibilityTimeout=self.receive_setting('VISIBILITY_TIMEOUT'))
+
+    def delete_messages(self, messages):
+        """
+        Delete processed messages in DeleteMessageBatch requests of up
+        to BATCH_SIZE entries.  Entries the batch request reports
+        as failed are retried individually.
+
+        :param messages: list of received messages to delete
+        :returns: list of messages that could not be deleted
+        """
+        from botocore.exceptions import ClientError
+
+        not_deleted = []
+        for i in range(0, len(messages), self.BATCH_SIZE):
+            batch = messages[i:i + self.BATCH_SIZE]
+            response = self._queue.delete_messages(Entries=[
+                {'Id': str(n), 'ReceiptHandle': msg.receipt_handle}
+                for n, msg in enumerate(batch)])
+
+            for failure in response.get('Failed', []):
+                msg = batch[int(failure['Id'])]
+                logger.warning('SQS: batch delete failed for {}: {}'.format(
+                    msg.receipt_handle, failure.get('Message',
+                                                    failure.get('Code'))))
+                try:
+                    msg.delete()
+                except ClientError as ex:
+                    logger.error('SQS: cannot delete {}: {}'.format(
+                        msg.receipt_handle, ex))
+                    not_deleted.append(msg)
+
+        return not_deleted
+
+    def change_visibility(self, messages, visibility_timeout):
+        """
+        Reset the visibility timeout of received messages in
+        ChangeMessageVisibilityBatch requests of up to BATCH_SIZE entries
+
+        :param messages: list of received messages
+        :param visibility_timeout: seconds from now the messages stay hidden
+        :returns: list of messages whose visibility could not be changed
+        """
+        failed = []
+        for i in range(0, len(messages), self.BATCH_SIZE):
+            batch = messages[i:i + self.BATCH_SIZE]
+            response = self._queue.change_message_visibility_batch(Entries=[
+                {'Id': str(n), 'ReceiptHandle': msg.receipt_handle,
+                 'VisibilityTimeout': visibility_timeout}
+                for n, msg in enumerate(batch)])
+
+            for failure in response.get('Failed', []):
+                msg = batch[int(failure['Id'])]
+                logger.warning(
+                    'SQS: visibility change failed for {}: {}'.format(
+                        msg.receipt_handle, failure.get(
+                            'Message', failure.get('Code'))))
+                failed.append(msg)
+
+        return failed
+
+    def send_message(self, body, message_attributes=None):
+        """
+        :param body: the message body text
+        :param message_attributes: optional dict of SQS message attributes
+        :returns: the SendMessage response
+        """
+        kwargs = {'MessageBody': body}
+        if message_attributes:
+            kwargs['MessageAttributes'] = message_attributes
+        return self._queue.send_message(**kwargs)
+
+
+class ReceiveTuner(object):
+    """
+    Tunes the poll count, long poll wait and visibility timeout of an
+    SQSQueue between the ADAPTIVE_* bounds in its settings.  A backlog
+    of messages gets as many polls as it takes to drain it with short
+    waits, while an empty queue gets one long poll.  The visibility
+    timeout follows the measured processing time per message.
+    """
+
+    DEFAULT_SAMPLE_INTERVAL = 30
+    DEFAULT_VISIBILITY_FACTOR = 2
+    DEFAULT_MAX_VISIBILITY_TIMEOUT = 900
+    MAX_WAIT_TIME = 20
+    MAX_VISIBILITY_TIMEOUT = 43200
+    SMOOTHING = 0.2
+
+    def __init__(self, sqs_queue, clock=time.monotonic):
+        """
+        :param sqs_queue: SQSQueue to tune
+        """
+        self._sqs = sqs_queue
+        self._clock = clock
+        settings = sqs_queue._settings
+        self._interval = settings.get(
+            'ADAPTIVE_SAMPLE_INTERVAL', self.DEFAULT_SAMPLE_INTERVAL)
+        self._factor = settings.get(
+            'ADAPTIVE_VISIBILITY_FACTOR', self.DEFAULT_VISIBILITY_FACTOR)
+        self._bounds = {
+            'POLL_COUNT': (
+                settings.get('ADAPTIVE_MIN_POLL_COUNT', 1),
+                settings.get('ADAPTIVE_MAX_POLL_COUNT', 10)),
+            'WAIT_TIME': (
+                settings.get('ADAPTIVE_MIN_WAIT_TIME', 1),
+                min(settings.get('ADAPTIVE_MAX_WAIT_TIME', self.MAX_WAIT_TIME),
+                    self.MAX_WAIT_TIME)),
+            'VISIBILITY_TIMEOUT': (
+                settings.get('ADAPTIVE_MIN_VISIBILITY_TIMEOUT',
+                             sqs_queue.receive_setting('VISIBILITY_TIMEOUT')),
+                min(settings.get('ADAPTIVE_MAX_VISIBILITY_TIMEOUT',
+                                 self.DEFAULT_MAX_VISIBILITY_TIMEOUT),
+                    self.MAX_VISIBILITY_TIMEOUT)),
+        }
+        self.values = {
+            name: self._clamp(name, sqs_queue.receive_setting(name))
+            for name in self._bounds}
+        self.depth = None
+        self.per_message = None
+        self._sampled_at = None
+
+    def sample(self):
+        """
+        Read ApproximateNumberOfMessages at most every
+        ADAPTIVE_SAMPLE_INTERVAL seconds, and retune
+        """
+        now = self._clock()
+        if self._sampled_at is not None and (
+                now - self._sampled_at < self._interval):
+            return
+
+        self._sampled_at = now
+        try:
+            queue = self._sqs._queue
+            queue.load()
+            self.depth = int(queue.attributes['ApproximateNumberOfMessages'])
+        except Exception as ex:
+            logger.warning('SQS: cannot sample queue depth: {}'.format(ex))
+            return
+
+        self._tune()
+
+    def record(self, count, seconds):
+        """
+        Fold a processed batch into the processing time per message, and
+        retune.  An empty receive means the queue has drained.
+        """
+        if count:
+            per_message = seconds / count
+            self.per_message = per_message if self.per_message is None else (
+                self.SMOOTHING * per_message +
+                (1 - self.SMOOTHING) * self.per_message)
+        else:
+            self.depth = 0
+
+        self._tune()
+
+    def _tune(self):
+        gather_size = self._sqs.receive_setting('MESSAGE_GATHER_SIZE')
+        if self.depth is not None:
+            if self.depth:
+                self.values['POLL_COUNT'] = self._clamp(
+                    'POLL_COUNT', math.ceil(self.depth / gather_size))
+                self.values['WAIT_TIME'] = self._bounds['WAIT_TIME'][0]
+            else:
+                self.values['POLL_COUNT'] = self._bounds['POLL_COUNT'][0]
+                self.values['WAIT_TIME'] = self._bounds['WAIT_TIME'][1]
+
+        if self.per_message is not None:
+            # cover processing everything one gather cycle can receive
+            self.values['VISIBILITY_TIMEOUT'] = self._clamp(
+                'VISIBILITY_TIMEOUT', math.ceil(
+                    self.per_message * self._factor * gather_size *
+                    self.values['POLL_COUNT']))
+
+    def _clamp(self, name, value):
+        low, high = self._bounds[name]
+        return int(min(max(value, low), high))
+
+
+class VisibilityHeartbeat(object):
+    """
+    Background thread that periodically extends the visibility timeout
+    of in-flight messages until they are released
+    """
+
+    def __init__(self, sqs_queue, visibility_timeout, interval=None):
+        """
+        :param sqs_queue: SQSQueue the messages were received from
+        :param visibility_timeout: seconds each extension hides messages
+        :param interval: seconds between extensions, default half of
+            visibility_timeout
+        """
+        self._sqs = sqs_queue
+        self._visibility_timeout = visibility_timeout
+        self._interval = interval if interval else visibility_timeout / 2
+        self._messages = {}
+        self._lock = Lock()
+        self._stopping = Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def track(self, messages):
+        with self._lock:
+            for msg in messages:
+                self._messages[msg.receipt_handle] = msg
+
+    def release(self, messages):
+        with self._lock:
+            for msg in messages:
+                self._messages.pop(msg.receipt_handle, None)
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, daemon=True,
+                              name='sqs-visibility-heartbeat')
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            self._messages.clear()
+
+    def beat(self):
+        with self._lock:
+            messages = list(self._messages.values())
+
+        if messages:
+            logger.debug('SQS: extending visibility of {} messages'.format(
+                len(messages)))
+            # messages that can no longer be extended are not retried
+            self.release(self._sqs.change_visibility(
+                messages, self._visibility_timeout))
+
+    def _run(self):
+        from botocore.exceptions import ClientError
+
+        while not self._stopping.wait(self._interval):
+            try:
+                self.beat()
+            except ClientError as ex:
+                logger.error('SQS: visibility heartbeat: {}'.format(ex))
@@ -0,0 +1,251 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Run a Gather loop in each of a number of forked worker processes
+
+    $ python -m aws_message.supervisor myapp.processors.MyProcessor -w 4
+"""
+
+from importlib import import_module
+from logging import getLogger
+from queue import Empty
+from threading import Event, Thread
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from aws_message.crypto import Signature
+from aws_message.gather import (
+    Gather, _catch_stop_signals, _check_processor, _restore_signals)
+from aws_message.metrics import InMemoryMetrics
+
+
+logger = getLogger(__name__)
+
+
+class SupervisorException(Exception):
+    pass
+
+
+class Supervisor(object):
+    """
+    Forks worker processes that each run Gather.run_forever on the same
+    queue, restarts those that exit, and aggregates their counters
+    """
+
+    DEFAULT_RESTART_DELAY = 1
+    DEFAULT_STATS_INTERVAL = 10
+    DEFAULT_DRAIN_TIMEOUT = 60
+
+    def __init__(self,
+                 processor=None,
+                 workers=None,
+                 sqs_settings=None,
+                 cert_urls=(),
+                 restart_delay=DEFAULT_RESTART_DELAY,
+                 stats_interval=DEFAULT_STATS_INTERVAL,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+        """
+        :param processor: A sub-class object of MessageBodyProcessor,
+            inherited by each worker
+        :param workers: number of worker processes, default one per CPU
+        :param cert_urls: signing certificate urls to fetch before forking
+        :param restart_delay: minimum seconds between starts of a worker
+        :param stats_interval: seconds between worker counter reports
+        :param drain_timeout: seconds workers have to finish the batch in
+            hand on shutdown before they are killed
+        """
+        if not processor:
+            raise SupervisorException('missing event processor')
+        _check_processor(processor)
+
+        self._processor = processor
+        self._settings = sqs_settings if (
+            sqs_settings) else processor.get_queue_settings()
+        self._workers = workers if workers else os.cpu_count() or 1
+        self._cert_urls = cert_urls
+        self._restart_delay = restart_delay
+        self._stats_interval = stats_interval
+        self._drain_timeout = drain_timeout
+
+        self._context = multiprocessing.get_context('fork')
+        self._processes = [None] * self._workers
+        self._started_at = [0] * self._workers
+        self._counters = {}
+        self._restarts = 0
+        self._start = None
+        self._stats_queue = None
+        self._stopping = Event()
+
+    def run(self, handle_signals=True):
+        """
+        Start the workers and keep them running until stop() is called
+        or, when handling signals, SIGTERM or SIGINT is received.  The
+        workers are then sent SIGTERM to finish the batch in hand.
+        """
+        self._warm()
+        self._stats_queue = self._context.Queue()
+        self._start = time.monotonic()
+        self._stopping.clear()
+
+        handlers = _catch_stop_signals(self.stop) if handle_signals else {}
+        logged_at = self._start
+        try:
+            while not self._stopping.is_set():
+                self._supervise()
+                self._collect(timeout=self._restart_delay)
+                if time.monotonic() - logged_at >= self._stats_interval:
+                    logged_at = time.monotonic()
+                    logger.info("SUPERVISOR: {}".format(self.stats()))
+        finally:
+            _restore_signals(handlers)
+            self._drain()
+
+    def stop(self):
+        """
+        Stop the workers once the batches in hand are processed
+        """
+        logger.info("SUPERVISOR: stopping")
+        self._stopping.set()
+
+    def stats(self):
+        """
+        :returns: dict of each worker's latest counters by pid, their
+            totals, the number of restarts and the received messages
+            per second since run began
+        """
+        totals = {}
+        for counters in self._counters.values():
+            for name, count in counters.items():
+                totals[name] = totals.get(name, 0) + count
+
+        elapsed = time.monotonic() - self._start if self._start else 0
+        return {
+            'workers': dict(self._counters),
+            'totals': totals,
+            'restarts': self._restarts,
+            'messages_per_second': round(
+                totals.get('received', 0) / elapsed, 1) if elapsed else 0,
+        }
+
+    def _warm(self):
+        """
+        Load what the workers share before they are forked
+        """
+        for module in ('boto3', 'cryptography.x509'):
+            import_module(module)
+
+        for cert_url in self._cert_urls:
+            Signature({'cert': {'type': 'url', 'reference': cert_url}})
+
+    def _supervise(self):
+        for i, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                continue
+
+            if process is not None:
+                logger.error("SUPERVISOR: worker {} exited with {}".format(
+                    process.pid, process.exitcode))
+                process.join()
+                self._processes[i] = None
+                self._restarts += 1
+
+            if time.monotonic() - self._started_at[i] >= self._restart_delay:
+                self._started_at[i] = time.monotonic()
+                self._processes[i] = self._context.Process(
+                    target=self._worker, name='gather-{}'.format(i))
+                self._processes[i].start()
+                logger.info("SUPERVISOR: started worker {}".format(
+                    self._processes[i].pid))
+
+    def _collect(self, timeout=0):
+        """
+        Record worker counter reports until the stats queue is empty
+        for timeout seconds
+        """
+        while True:
+            try:
+                pid, counters = self._stats_queue.get(timeout=timeout)
+            except Empty:
+                return
+
+            self._counters[pid] = counters
+            timeout = 0
+
+    def _drain(self):
+        processes = [p for p in self._processes if p is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self._drain_timeout
+        for process in processes:
+            while process.is_alive() and time.monotonic() < deadline:
+                self._collect(timeout=0.1)
+                process.join(timeout=0.1)
+            if process.is_alive():
+                logger.error("SUPERVISOR: killing worker {}".format(
+                    process.pid))
+                process.kill()
+                process.join()
+
+        self._collect()
+        self._processes = [None] * self._workers
+        logger.info("SUPERVISOR: {}".format(self.stats()))
+
+    def _gather(self, metrics):
+        return Gather(processor=self._processor, sqs_settings=self._settings,
+                      metrics=metrics)
+
+    def _worker(self):
+        # drop the inherited supervisor stop handlers, so that a signal
+        # ends the worker until run_forever installs its own
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        metrics = InMemoryMetrics()
+        gather = self._gather(metrics)
+        reporting = Event()
+
+        def report():
+            self._stats_queue.put((os.getpid(), metrics.counters()))
+
+        def report_forever():
+            while not reporting.wait(self._stats_interval):
+                report()
+
+        Thread(target=report_forever, daemon=True).start()
+        try:
+            gather.run_forever()
+        finally:
+            reporting.set()
+            report()
+            self._stats_queue.close()
+            self._stats_queue.join_thread()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('processor',
+                        help='dotted path of the MessageBodyProcessor class')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='worker processes, default one per CPU')
+    parser.add_argument('--cert-url', action='append', default=[],
+                        help='signing certificate url to fetch up front')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    module_name, class_name = args.processor.rsplit('.', 1)
+    processor = getattr(import_module(module_name), class_name)()
+    Supervisor(processor=processor, workers=args.workers,
+               cert_urls=args.cert_url).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
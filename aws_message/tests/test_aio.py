@@ -0,0 +1,106 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from commonconf import override_settings
+from aws_message.aio import AsyncGather
+from aws_message.codec import JSONCodec
+from aws_message.gather import Gather, GatherException, MultiGather
+from aws_message.processor import MessageBodyProcessor, ProcessorException
+from aws_message.supervisor import Supervisor
+from aws_message.tests.test_gather import (
+    QUEUE_SETTINGS, MockQueue, MockProcessor)
+
+logger = logging.getLogger(__name__)
+
+
+class MockAsyncProcessor(MessageBodyProcessor):
+    def __init__(self):
+        super(MockAsyncProcessor, self).__init__(
+            logger, queue_settings_name='TEST')
+        self.processed = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def process_message_body(self, json_data):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if json_data.get('fail'):
+            raise ProcessorException('failed {}'.format(json_data['id']))
+        self.processed.append(json_data['id'])
+
+
+class MockCodec(JSONCodec):
+    decoded = []
+
+    @classmethod
+    def loads(cls, data):
+        cls.decoded.append(data)
+        return super(MockCodec, cls).loads(data)
+
+
+def mock_gather(processor, bodies, **settings):
+    gather = AsyncGather(processor=processor,
+                         sqs_settings=dict(QUEUE_SETTINGS, **settings))
+    gather._queue._queue = MockQueue(bodies)
+    return gather
+
+
+class TestAsyncGather(TestCase):
+    def test_missing_processor(self):
+        self.assertRaises(GatherException, AsyncGather)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_blocking_gatherers(self):
+        # they would delete messages without awaiting their processing
+        processor = MockAsyncProcessor()
+        self.assertRaises(GatherException, Gather, processor=processor,
+                          sqs_settings=QUEUE_SETTINGS)
+        self.assertRaises(GatherException, MultiGather, [processor])
+        self.assertRaises(GatherException, Supervisor, processor=processor,
+                          sqs_settings=QUEUE_SETTINGS)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events(self):
+        bodies = [{'id': i, 'fail': (i == 3)} for i in range(10)]
+        gather = mock_gather(MockAsyncProcessor(), bodies)
+        asyncio.run(gather.gather_events())
+
+        processor = gather._processor
+        self.assertEqual(sorted(processor.processed),
+                         [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(processor.max_in_flight, 10)
+        self.assertEqual(len(gather._queue._queue.deleted), 9)
+        self.assertNotIn('rh3', gather._queue._queue.deleted)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_codec(self):
+        with patch('aws_message.aio.get_codec',
+                   return_value=MockCodec) as get_codec:
+            gather = mock_gather(MockAsyncProcessor(), [{'id': 0}],
+                                 JSON_CODEC='orjson')
+        asyncio.run(gather.gather_events())
+        get_codec.assert_called_once_with('orjson')
+        self.assertEqual(MockCodec.decoded, ['{"id": 0}'])
+        self.assertEqual(gather._processor.processed, [0])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_bounded(self):
+        bodies = [{'id': i} for i in range(10)]
+        gather = mock_gather(MockAsyncProcessor(), bodies, PROCESS_WORKERS=3)
+        asyncio.run(gather.gather_events())
+        self.assertEqual(gather._processor.max_in_flight, 3)
+        self.assertEqual(len(gather._processor.processed), 10)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_sync_processor(self):
+        bodies = [{'id': 0}, {'id': 1, 'fail': True}]
+        gather = mock_gather(MockProcessor(), bodies)
+        asyncio.run(gather.gather_events())
+        self.assertEqual(gather._processor.processed, [0])
+        self.assertEqual(gather._queue._queue.deleted, ['rh0'])
@@ -0,0 +1,28 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from commonconf import override_settings
+from aws_message.benchmark import SCENARIOS, run_scenario, regressions
+
+
+class TestBenchmark(TestCase):
+    @override_settings(AWS_SQS={'BENCHMARK': {}})
+    def test_scenarios(self):
+        for scenario in SCENARIOS:
+            result = run_scenario(scenario, 10, 20)
+            self.assertEqual(result['scenario'], scenario)
+            self.assertEqual(result['messages'], 20)
+            self.assertGreater(result['messages_per_second'], 0)
+
+    def test_regressions(self):
+        baseline = {'results': [
+            {'scenario': 'json', 'batch_size': 10,
+             'messages_per_second': 1000.0}]}
+        fast = {'scenario': 'json', 'batch_size': 10,
+                'messages_per_second': 900.0}
+        slow = dict(fast, messages_per_second=700.0)
+        other = dict(slow, batch_size=100)
+        self.assertEqual(regressions([fast, other], baseline, 0.2), [])
+        self.assertEqual(regressions([slow], baseline, 0.2),
+                         [(slow, 1000.0)])
@@ -0,0 +1,41 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from aws_message.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+    def test_get_set(self):
+        cache = TTLCache(maxsize=2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'x'), 'x')
+        self.assertEqual(cache.stats(), {
+            'hits': 1, 'misses': 2, 'size': 1, 'maxsize': 2})
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_bounded(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_expire(self):
+        cache = TTLCache(ttl=60)
+        cache.set('a', 1, ttl=0)
+        cache.set('b', 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.stats()['hits'], 0)
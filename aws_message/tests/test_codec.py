@@ -0,0 +1,26 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase, skipUnless
+from aws_message.codec import get_codec, JSONCodec, OrjsonCodec, orjson
+
+
+class TestCodec(TestCase):
+    def test_get_codec(self):
+        self.assertEqual(get_codec(), JSONCodec)
+        self.assertEqual(get_codec('json'), JSONCodec)
+        self.assertRaises(ValueError, get_codec, 'yaml')
+
+    def test_json(self):
+        self.assertEqual(JSONCodec.loads(b'{"a": [1]}'), {'a': [1]})
+        self.assertEqual(JSONCodec.loads(JSONCodec.dumps({'a': 1})),
+                         {'a': 1})
+        self.assertRaises(ValueError, JSONCodec.loads, 'abc')
+
+    @skipUnless(orjson, "orjson is not installed")
+    def test_orjson(self):
+        self.assertEqual(get_codec('orjson'), OrjsonCodec)
+        self.assertEqual(get_codec('auto'), OrjsonCodec)
+        self.assertEqual(OrjsonCodec.loads(memoryview(b'[1, 2]')), [1, 2])
+        self.assertEqual(OrjsonCodec.dumps({'a': 1}), '{"a":1}')
+        self.assertRaises(ValueError, OrjsonCodec.loads, 'abc')
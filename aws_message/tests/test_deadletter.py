@@ -0,0 +1,71 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+from commonconf import override_settings
+from aws_message.deadletter import (
+    DeadLetterException, DeadLetterSink, FileDeadLetterSink,
+    QueueDeadLetterSink, get_dead_letter_sink)
+from aws_message.mock_sqs import SQSQueueMock
+
+DLQ_SETTINGS = {
+    'QUEUE_ARN': 'arn:aws:sqs:xx-mock-999:000000000000:ww-wwww-dlq',
+    'KEY_ID': 'XXXXXXXXXXXXXXXX',
+    'KEY': 'YYYYYYYYYYYYYYYYYYYYYYYY',
+}
+
+
+def poison_message():
+    queue = SQSQueueMock()
+    queue.send_message(MessageBody='{"id": 1}')
+    for i in range(3):
+        msg = queue.receive_messages(VisibilityTimeout=0)[0]
+    return msg
+
+
+class TestDeadLetter(TestCase):
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dead.jsonl')
+            sink = get_dead_letter_sink({'DEAD_LETTER_FILE': path})
+            self.assertIsInstance(sink, FileDeadLetterSink)
+            sink.send(poison_message(), 'failed')
+            sink.send(poison_message(), 'failed again')
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+
+        self.assertEqual([line['reason'] for line in lines],
+                         ['failed', 'failed again'])
+        self.assertEqual(lines[0]['body'], '{"id": 1}')
+        self.assertEqual(lines[0]['receive_count'], 3)
+
+        sink = FileDeadLetterSink(os.path.join(tmpdir, 'missing', 'x'))
+        self.assertRaises(DeadLetterException, sink.send,
+                          poison_message(), 'failed')
+
+    @override_settings(AWS_SQS={'DLQ': DLQ_SETTINGS})
+    def test_queue(self):
+        sink = get_dead_letter_sink({'DEAD_LETTER_QUEUE': 'DLQ'})
+        self.assertIsInstance(sink, QueueDeadLetterSink)
+        sink._sqs._queue = SQSQueueMock()
+        sink.send(poison_message(), 'failed')
+
+        msg = sink._sqs._queue.receive_messages()[0]
+        self.assertEqual(msg.body, '{"id": 1}')
+        self.assertEqual(
+            msg.message_attributes['DeadLetterReason']['StringValue'],
+            'failed')
+        self.assertEqual(
+            msg.message_attributes['ReceiveCount']['StringValue'], '3')
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, DeadLetterSink)
+
+    @override_settings(AWS_SQS={})
+    def test_get_dead_letter_sink(self):
+        self.assertIsNone(get_dead_letter_sink({}))
+        self.assertRaises(DeadLetterException, get_dead_letter_sink,
+                          {'DEAD_LETTER_QUEUE': 'DLQ'})
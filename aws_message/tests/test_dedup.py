@@ -0,0 +1,44 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from unittest.mock import patch
+from aws_message.dedup import MessageDedup
+
+
+class MockMemcached(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, expire=0):
+        self.data[key] = value
+
+
+class TestMessageDedup(TestCase):
+    def test_local(self):
+        dedup = MessageDedup(maxsize=2)
+        self.assertFalse(dedup.seen('a'))
+        dedup.record('a')
+        self.assertTrue(dedup.seen('a'))
+        dedup.record('b')
+        dedup.record('c')
+        self.assertFalse(dedup.seen('a'))
+
+        dedup.record(None)
+        self.assertFalse(dedup.seen(None))
+
+    def test_memcached(self):
+        memcached = MockMemcached()
+        with patch('memcached_clients.PymemcacheClient',
+                   return_value=memcached):
+            dedup = MessageDedup(use_memcached=True)
+            other = MessageDedup(use_memcached=True)
+
+        dedup.record('a')
+        self.assertEqual(len(memcached.data), 1)
+        self.assertTrue(other.seen('a'))
+        self.assertFalse(other.seen('b'))
+        self.assertEqual(other.stats()['size'], 1)
@@ -0,0 +1,570 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from commonconf import override_settings
+from aws_message import gather as gather_module
+from aws_message.gather import Gather, GatherException, MultiGather
+from aws_message.processor import MessageBodyProcessor, ProcessorException
+from aws_message.crypto import Signature, public_key_cache
+from aws_message.metrics import InMemoryMetrics
+from aws_message.mock_sqs import SQSQueueMock
+from aws_message.tests.test_message import (
+    TEST_MSG_SNS, TEST_CERT_URL, signing_cert, signed_sns_message)
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SETTINGS = {
+    'QUEUE_ARN': 'arn:aws:sqs:xx-mock-999:000000000000:ww-wwww-1',
+    'KEY_ID': 'XXXXXXXXXXXXXXXX',
+    'KEY': 'YYYYYYYYYYYYYYYYYYYYYYYY',
+    'VALIDATE_SNS_SIGNATURE': False,
+}
+
+
+class MockMessage(object):
+    def __init__(self, body, receipt_handle, attributes=None):
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.attributes = attributes if attributes else {}
+        self.message_id = 'id-{}'.format(body)
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class MockQueue(object):
+    def __init__(self, bodies):
+        sent_timestamp = str(int(time.time() * 1000) - 2000)
+        self.messages = [MockMessage(json.dumps(body), 'rh{}'.format(i), {
+            'SentTimestamp': sent_timestamp,
+            'ApproximateReceiveCount': '1'})
+            for i, body in enumerate(bodies)]
+        self.deleted = []
+        self.extended = []
+        self.visibility = {}
+
+    def receive_messages(self, **kwargs):
+        messages = self.messages[:kwargs.get('MaxNumberOfMessages')]
+        self.messages = self.messages[len(messages):]
+        return messages
+
+    def change_message_visibility_batch(self, Entries):
+        self.extended.extend([e['ReceiptHandle'] for e in Entries])
+        self.visibility.update(
+            {e['ReceiptHandle']: e['VisibilityTimeout'] for e in Entries})
+        return {'Successful': [{'Id': e['Id']} for e in Entries]}
+
+    def delete_messages(self, Entries):
+        self.deleted.extend([e['ReceiptHandle'] for e in Entries])
+        return {'Successful': [{'Id': e['Id']} for e in Entries]}
+
+
+class MockProcessor(MessageBodyProcessor):
+    def __init__(self, queue_settings_name='TEST'):
+        super(MockProcessor, self).__init__(
+            logger, queue_settings_name=queue_settings_name)
+        self.processed = []
+
+    def process_message_body(self, json_data):
+        if json_data.get('fail'):
+            raise ProcessorException('failed {}'.format(json_data['id']))
+        self.processed.append(json_data['id'])
+
+
+class MockBatchProcessor(MockProcessor):
+    def __init__(self):
+        super(MockBatchProcessor, self).__init__()
+        self.batches = []
+
+    def process_batch(self, payloads):
+        self.batches.append([p['id'] for p in payloads])
+        return [i for i, p in enumerate(payloads) if p.get('fail')]
+
+
+class MockTransactionProcessor(MockBatchProcessor):
+    def process_batch(self, payloads):
+        failed = super(MockTransactionProcessor, self).process_batch(
+            payloads)
+        if failed:
+            raise ProcessorException('rolled back')
+        return failed
+
+
+def mock_gather(bodies, **settings):
+    queue_settings = dict(QUEUE_SETTINGS, **settings)
+    gather = Gather(processor=MockProcessor(), sqs_settings=queue_settings)
+    gather._queue._queue = MockQueue(bodies)
+    return gather
+
+
+class TestGatherBatchValidate(TestCase):
+    def setUp(self):
+        key, pem = signing_cert()
+        self.key = key
+        public_key_cache.clear()
+        public_key_cache.set(TEST_CERT_URL, (
+            pem, Signature._load_public_key(pem)))
+
+    def tearDown(self):
+        public_key_cache.clear()
+
+    def signed_bodies(self, count):
+        bodies = []
+        for i in range(count):
+            body = signed_sns_message(
+                self.key, dict(TEST_MSG_SNS, Message=json.dumps({'id': i})))
+            if i % 4 == 1:
+                body['Message'] = json.dumps({'id': -i})
+            bodies.append(body)
+        return bodies
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_batch_validate(self):
+        gather = mock_gather(self.signed_bodies(8),
+                             VALIDATE_SNS_SIGNATURE=True,
+                             BATCH_VALIDATE=True, VALIDATE_WORKERS=2)
+        gather.gather_events()
+        gather.close()
+        self.assertEqual(gather._processor.processed, [0, 2, 3, 4, 6, 7])
+        self.assertEqual(gather._queue._queue.deleted, [
+            'rh0', 'rh2', 'rh3', 'rh4', 'rh6', 'rh7'])
+
+
+class TestGather(TestCase):
+    def test_missing_processor(self):
+        self.assertRaises(GatherException, Gather)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events(self):
+        gather = mock_gather([{'id': i} for i in range(10)])
+        gather.gather_events()
+        self.assertEqual(gather._processor.processed, list(range(10)))
+        self.assertEqual(gather._queue._queue.deleted,
+                         ['rh{}'.format(i) for i in range(10)])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_processor_exception(self):
+        gather = mock_gather([{'id': 0}, {'id': 1, 'fail': True}, {'id': 2}])
+        gather.gather_events()
+        self.assertEqual(gather._processor.processed, [0, 2])
+        self.assertEqual(gather._queue._queue.deleted, ['rh0', 'rh2'])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_workers(self):
+        bodies = [{'id': i, 'fail': (i % 3 == 0)} for i in range(10)]
+        gather = mock_gather(bodies, PROCESS_WORKERS=4)
+        gather.gather_events()
+        self.assertEqual(sorted(gather._processor.processed),
+                         [1, 2, 4, 5, 7, 8])
+        self.assertEqual(sorted(gather._queue._queue.deleted),
+                         sorted(['rh{}'.format(i) for i in (
+                             1, 2, 4, 5, 7, 8)]))
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_workers_pool(self):
+        gather = mock_gather([{'id': i} for i in range(20)],
+                             PROCESS_WORKERS=4)
+        gather.gather_events()
+        executor = gather._process_executor
+        gather.gather_events()
+        self.assertIs(gather._process_executor, executor)
+        self.assertEqual(sorted(gather._processor.processed), list(range(20)))
+
+        gather.close()
+        self.assertIsNone(gather._process_executor)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_heartbeat(self):
+        gather = mock_gather([{'id': 0, 'fail': True}, {'id': 1}],
+                             VISIBILITY_HEARTBEAT=True,
+                             HEARTBEAT_INTERVAL=0.01)
+
+        def process_message_body(json_data):
+            time.sleep(0.1)
+            if json_data.get('fail'):
+                raise ProcessorException('failed')
+            gather._processor.processed.append(json_data['id'])
+
+        gather._processor.process_message_body = process_message_body
+        gather.gather_events()
+
+        queue = gather._queue._queue
+        self.assertEqual(queue.deleted, ['rh1'])
+        self.assertIn('rh0', queue.extended)
+        # the failed message is no longer extended once processed
+        self.assertGreater(
+            queue.extended.count('rh1'), queue.extended.count('rh0'))
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_heartbeat_deleted(self):
+        gather = mock_gather([{'id': 0}], VISIBILITY_HEARTBEAT=True,
+                             HEARTBEAT_INTERVAL=0.01)
+        queue = gather._queue._queue
+        extended = []
+
+        def delete_messages(Entries):
+            extended.append(len(queue.extended))
+            time.sleep(0.1)
+            return MockQueue.delete_messages(queue, Entries)
+
+        queue.delete_messages = delete_messages
+        gather.gather_events()
+        # no extensions of the message once it is being deleted
+        self.assertEqual(queue.deleted, ['rh0'])
+        self.assertEqual(len(queue.extended), extended[0])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_process_batch(self):
+        bodies = [{'id': i, 'fail': (i in (2, 5))} for i in range(8)]
+        gather = mock_gather(bodies, PROCESS_BATCH=True)
+        gather._processor = MockBatchProcessor()
+        gather.gather_events()
+        self.assertEqual(gather._processor.batches, [list(range(8))])
+        self.assertEqual(gather._queue._queue.deleted, [
+            'rh0', 'rh1', 'rh3', 'rh4', 'rh6', 'rh7'])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_process_batch_default(self):
+        bodies = [{'id': i, 'fail': (i == 1)} for i in range(3)]
+        gather = mock_gather(bodies, PROCESS_BATCH=True)
+        gather.gather_events()
+        self.assertEqual(gather._processor.processed, [0, 2])
+        self.assertEqual(gather._queue._queue.deleted, ['rh0', 'rh2'])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_process_batch_exception(self):
+        gather = mock_gather(
+            [{'id': 0}, {'id': 1, 'fail': True}, TEST_MSG_SNS],
+            PROCESS_BATCH=True, TOPIC_ARN='arn:aws:sns:us-east-1:1:other')
+        gather._processor = MockTransactionProcessor()
+        self.assertEqual(gather.gather_events(), 3)
+        self.assertEqual(gather._processor.batches, [[0, 1]])
+        # only the invalid message is deleted
+        self.assertEqual(gather._queue._queue.deleted, ['rh2'])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_process_batch_invalid_indexes(self):
+        gather = mock_gather([{'id': 0}, {'id': 1}], PROCESS_BATCH=True)
+        gather._processor = MockBatchProcessor()
+        gather._processor.process_batch = lambda payloads: [2]
+        gather.gather_events()
+        self.assertEqual(gather._queue._queue.deleted, [])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_malformed_body(self):
+        for settings in ({}, {'PROCESS_WORKERS': 3}, {'PROCESS_BATCH': True},
+                         {'BATCH_VALIDATE': True}):
+            gather = mock_gather([{'id': i} for i in range(5)], **settings)
+            gather._queue._queue.messages[2].body = '{"id": 2'
+            self.assertEqual(gather.gather_events(), 5)
+            self.assertEqual(sorted(gather._processor.processed),
+                             [0, 1, 3, 4])
+            self.assertEqual(sorted(gather._queue._queue.deleted),
+                             ['rh0', 'rh1', 'rh3', 'rh4'])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_metrics(self):
+        metrics = InMemoryMetrics()
+        gather = Gather(processor=MockProcessor(), sqs_settings=dict(
+            QUEUE_SETTINGS, TOPIC_ARN='arn:aws:sns:us-east-1:1:other'),
+            metrics=metrics)
+        gather._queue._queue = MockQueue(
+            [{'id': 0}, {'id': 1, 'fail': True}, TEST_MSG_SNS])
+        gather.gather_events()
+
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], {
+            'received': 3, 'failed': 1, 'invalid': 1})
+        self.assertEqual(summary['stats']['batch_size']['max'], 3)
+        for stage, count in [('receive', 1), ('parse', 3), ('validate', 3),
+                             ('extract', 2), ('process', 2), ('delete', 1)]:
+            self.assertEqual(summary['stats'][stage]['count'], count)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_lag(self):
+        metrics = InMemoryMetrics()
+        gather = Gather(processor=MockProcessor(), sqs_settings=QUEUE_SETTINGS,
+                        metrics=metrics)
+        gather._queue._queue = MockQueue([
+            {'id': 0}, {'id': 1, 'fail': True},
+            dict(TEST_MSG_SNS, Message=json.dumps({'id': 2}))])
+        gather.gather_events()
+
+        stats = metrics.summary()['stats']
+        self.assertEqual(stats['receive_lag']['count'], 3)
+        self.assertEqual(stats['ack_lag']['count'], 2)
+        self.assertEqual(stats['receive_count']['max'], 1)
+        self.assertGreater(metrics.percentile('receive_lag', 50), 1.5)
+        self.assertLess(metrics.percentile('receive_lag', 50), 60)
+        # SNS publish time precedes the SQS sent time
+        self.assertGreater(stats['receive_lag']['max'], 60 * 60 * 24)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_dedup(self):
+        bodies = [{'id': 0}, {'id': 1, 'fail': True},
+                  dict(TEST_MSG_SNS, Message=json.dumps({'id': 2}))]
+        gather = mock_gather(bodies, DEDUP=True)
+        gather.gather_events()
+        self.assertEqual(gather._processor.processed, [0, 2])
+
+        # redelivered, with a new SQS message id for the SNS message
+        redelivered = bodies + [
+            dict(TEST_MSG_SNS, Message=json.dumps({'id': 2}), Subject='x')]
+        gather._queue._queue = MockQueue(redelivered)
+        gather.gather_events()
+        self.assertEqual(gather._processor.processed, [0, 2])
+        self.assertEqual(gather._queue._queue.deleted, ['rh0', 'rh2', 'rh3'])
+
+
+class TestGatherMockSQS(TestCase):
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_visibility_lapsed(self):
+        now = [0]
+        queue = SQSQueueMock(clock=lambda: now[0])
+        for i in range(3):
+            queue.send_message(MessageBody=json.dumps({'id': i}))
+        gather = mock_gather([], VISIBILITY_TIMEOUT=10)
+        gather._queue._queue = queue
+
+        def process_message_body(json_data):
+            gather._processor.processed.append(json_data['id'])
+            if json_data['id'] == 2:
+                # the visibility timeout lapses before the delete
+                now[0] = 11
+
+        gather._processor.process_message_body = process_message_body
+        self.assertEqual(gather.gather_events(), 3)
+        self.assertEqual(queue.attributes['ApproximateNumberOfMessages'], '3')
+
+        # redelivered, and deleted in time
+        self.assertEqual(gather.gather_events(), 3)
+        self.assertEqual(gather.gather_events(), 0)
+        self.assertEqual(sorted(gather._processor.processed[3:]), [0, 1, 2])
+
+
+class TestGatherPoison(TestCase):
+    def poison_gather(self, **settings):
+        bodies = [{'id': 0}] + [{'id': i, 'fail': True} for i in (1, 2, 3)]
+        gather = mock_gather(bodies, VISIBILITY_TIMEOUT=10, **settings)
+        for i, msg in enumerate(gather._queue._queue.messages):
+            msg.attributes['ApproximateReceiveCount'] = str(max(i, 1))
+        return gather
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_missing_dead_letter_sink(self):
+        self.assertRaises(GatherException, mock_gather, [],
+                          MAX_RECEIVE_COUNT=3)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_redelivery_backoff(self):
+        gather = self.poison_gather(REDELIVERY_BACKOFF=True)
+        gather.gather_events()
+        queue = gather._queue._queue
+        self.assertEqual(queue.deleted, ['rh0'])
+        self.assertEqual(queue.visibility, {'rh1': 10, 'rh2': 20, 'rh3': 40})
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_dead_letter(self):
+        metrics = InMemoryMetrics()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dead.jsonl')
+            gather = self.poison_gather(REDELIVERY_BACKOFF=True,
+                                        MAX_RECEIVE_COUNT=3,
+                                        DEAD_LETTER_FILE=path)
+            gather._metrics = metrics
+            gather.gather_events()
+            with open(path) as f:
+                diverted = [json.loads(line) for line in f]
+
+        queue = gather._queue._queue
+        self.assertEqual(queue.deleted, ['rh0', 'rh3'])
+        self.assertEqual(queue.visibility, {'rh1': 10, 'rh2': 20})
+        self.assertEqual(len(diverted), 1)
+        self.assertEqual(json.loads(diverted[0]['body']), {
+            'id': 3, 'fail': True})
+        self.assertEqual(diverted[0]['receive_count'], 3)
+        self.assertEqual(metrics.counter('dead_lettered'), 1)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_dead_letter_malformed_body(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dead.jsonl')
+            gather = self.poison_gather(MAX_RECEIVE_COUNT=3,
+                                        DEAD_LETTER_FILE=path)
+            gather._queue._queue.messages[3].body = 'not json'
+            gather.gather_events()
+            with open(path) as f:
+                diverted = [json.loads(line) for line in f]
+
+        self.assertEqual(gather._queue._queue.deleted, ['rh0', 'rh3'])
+        self.assertEqual([d['body'] for d in diverted], ['not json'])
+
+
+class TestGatherPrefetch(TestCase):
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_prefetch(self):
+        gather = mock_gather([{'id': i} for i in range(25)], PREFETCH=True)
+        counts = []
+        while not counts or counts[-1]:
+            counts.append(gather.gather_events())
+        gather.close()
+
+        self.assertEqual(counts, [10, 10, 5, 0])
+        self.assertEqual(gather._processor.processed, list(range(25)))
+        self.assertIsNone(gather._prefetcher)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_gather_events_prefetch_stale(self):
+        metrics = InMemoryMetrics()
+        gather = Gather(processor=MockProcessor(), metrics=metrics,
+                        sqs_settings=dict(
+                            QUEUE_SETTINGS, PREFETCH=True,
+                            PREFETCH_MAX_AGE=0.05, MESSAGE_GATHER_SIZE=1))
+        gather._queue._queue = MockQueue([{'id': i} for i in range(4)])
+        self.assertEqual(gather.gather_events(), 1)
+        time.sleep(0.1)
+        self.assertEqual(gather.gather_events(), 1)
+        gather.close()
+
+        # the second batch aged while prefetched
+        self.assertEqual(gather._processor.processed, [0, 2])
+        self.assertEqual(metrics.counter('stale'), 1)
+        self.assertEqual(gather._queue._queue.extended[0], 'rh1')
+        self.assertNotIn('rh2', gather._queue._queue.extended)
+
+
+class TestGatherRunForever(TestCase):
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_run_forever_idle_backoff(self):
+        gather = mock_gather([{'id': i} for i in range(15)],
+                             IDLE_BACKOFF_MIN=0.01, IDLE_BACKOFF_MAX=0.02)
+        waits = []
+        gather._stopping.wait = lambda timeout: waits.append(timeout) or (
+            len(waits) == 4 and gather.stop())
+        gather.run_forever(handle_signals=False)
+
+        self.assertEqual(gather._processor.processed, list(range(15)))
+        self.assertEqual(len(gather._queue._queue.deleted), 15)
+        self.assertEqual(waits, [0.01, 0.02, 0.02, 0.02])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_run_forever_signal(self):
+        gather = mock_gather([{'id': i} for i in range(25)])
+
+        def process_message_body(json_data):
+            gather._processor.processed.append(json_data['id'])
+            if json_data['id'] == 12:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        gather._processor.process_message_body = process_message_body
+        handler = signal.getsignal(signal.SIGTERM)
+        gather.run_forever()
+
+        # the batch in hand completes before stopping
+        self.assertEqual(gather._processor.processed, list(range(20)))
+        self.assertEqual(len(gather._queue._queue.deleted), 20)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), handler)
+
+
+MULTI_SETTINGS = {
+    'A': dict(QUEUE_SETTINGS, WEIGHT=3, MESSAGE_GATHER_SIZE=1,
+              QUEUE_ARN='arn:aws:sqs:xx-mock-999:000000000000:aa-aaaa-1'),
+    'B': dict(QUEUE_SETTINGS, MESSAGE_GATHER_SIZE=1,
+              IDLE_BACKOFF_MIN=0.01, IDLE_BACKOFF_MAX=0.02,
+              QUEUE_ARN='arn:aws:sqs:xx-mock-999:000000000000:bb-bbbb-1'),
+}
+
+
+def mock_multi_gather(bodies, max_workers=None):
+    multi = MultiGather([MockProcessor(name) for name in sorted(bodies)],
+                        max_workers=max_workers)
+    for gatherer, name in zip(multi._gatherers, sorted(bodies)):
+        gatherer._queue._queue = MockQueue(bodies[name])
+    return multi
+
+
+class TestMultiGather(TestCase):
+    def test_missing_processors(self):
+        self.assertRaises(GatherException, MultiGather, [])
+
+    @override_settings(AWS_SQS=MULTI_SETTINGS)
+    def test_gather_events(self):
+        multi = mock_multi_gather({'A': [{'id': 0}, {'id': 1}],
+                                   'B': [{'id': 2}]})
+        a, b = multi._gatherers
+        self.assertIs(a._queue.sqs_client, b._queue.sqs_client)
+
+        self.assertEqual(multi.gather_events(), 2)
+        self.assertEqual(a._processor.processed, [0])
+        self.assertEqual(b._processor.processed, [2])
+        self.assertEqual(multi.gather_events(), 1)
+        multi.close()
+        self.assertEqual(a._processor.processed, [0, 1])
+
+    @override_settings(AWS_SQS=MULTI_SETTINGS)
+    def test_run_forever_weighted(self):
+        multi = mock_multi_gather({
+            'A': [{'id': i} for i in range(20)],
+            'B': [{'id': i} for i in range(100, 120)]}, max_workers=1)
+        order = []
+
+        def processed(name):
+            def process_message_body(json_data):
+                order.append(name)
+                if len(order) == 8:
+                    multi.stop()
+            return process_message_body
+
+        for gatherer, name in zip(multi._gatherers, 'AB'):
+            gatherer._processor.process_message_body = processed(name)
+
+        multi.run_forever(handle_signals=False)
+        self.assertEqual(order, list('AABAAABA'))
+
+    @override_settings(AWS_SQS=MULTI_SETTINGS)
+    def test_run_forever_workers_busy(self):
+        multi = mock_multi_gather({
+            'A': [{'id': i} for i in range(20)],
+            'B': [{'id': i} for i in range(100, 120)]}, max_workers=1)
+        processed = []
+
+        def process_message_body(json_data):
+            time.sleep(0.01)
+            processed.append(json_data['id'])
+            if len(processed) == 10:
+                multi.stop()
+
+        for gatherer in multi._gatherers:
+            gatherer._processor.process_message_body = process_message_body
+
+        # the ready queue waiting for the thread must not busy loop
+        with patch.object(gather_module, 'wait',
+                          wraps=gather_module.wait) as wait:
+            multi.run_forever(handle_signals=False)
+        self.assertEqual(len(processed), 10)
+        self.assertLessEqual(wait.call_count, 10)
+
+    @override_settings(AWS_SQS=MULTI_SETTINGS)
+    def test_run_forever_idle_queue(self):
+        multi = mock_multi_gather({'A': [{'id': i} for i in range(5)],
+                                   'B': []})
+        a, b = multi._gatherers
+
+        def process_message_body(json_data):
+            a._processor.processed.append(json_data['id'])
+            if len(a._processor.processed) == 5:
+                multi.stop()
+
+        a._processor.process_message_body = process_message_body
+        multi.run_forever(handle_signals=False)
+        self.assertEqual(a._processor.processed, list(range(5)))
+        self.assertGreater(multi._backoff[1], 0)
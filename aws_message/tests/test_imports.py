@@ -0,0 +1,44 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+# heavy dependencies that must wait until they are first used
+DEFERRED = ['boto3', 'botocore', 'cryptography', 'urllib3',
+            'memcached_clients', 'pymemcache']
+
+# seconds, the best of a few runs, to import aws_message.gather
+IMPORT_TIME_BUDGET = 0.25
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import aws_message.gather
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'modules': [name for name in sys.modules
+                if name.split('.')[0] in %r],
+}))
+''' % (DEFERRED,)
+
+
+def import_gather():
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT],
+                            check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(
+                                os.path.dirname(os.path.abspath(__file__))))
+                            ).stdout
+    return json.loads(output)
+
+
+class TestImports(TestCase):
+    def test_deferred_imports(self):
+        self.assertEqual(import_gather()['modules'], [])
+
+    def test_import_time(self):
+        seconds = min(import_gather()['seconds'] for i in range(3))
+        self.assertLess(seconds, IMPORT_TIME_BUDGET)
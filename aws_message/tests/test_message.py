@@ -4,7 +4,23 @@
 from unittest import TestCase, skipUnless
 from commonconf import settings, override_settings
 from aws_message.message import Message
-from aws_message.crypto import Signature, aes128cbc, CryptoException
+from aws_message.crypto import (
+    Signature, aes128cbc, aesgcm, CryptoException, public_key_cache,
+    cert_failure_cache, _fetch_locks)
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+from unittest.mock import patch
+import datetime
+import urllib3
+import time
 import os
 
 TEST_MESSAGES = [
@@ -50,6 +66,28 @@ TEST_MSG_SNS_B64 = {
     'Subject': 'UW Event',
 }
 
+TEST_CERT_URL = 'https://sns.us-east-1.amazonaws.com/test.pem'
+
+
+def signing_cert():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'test')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+        name).public_key(key.public_key()).serial_number(1).not_valid_before(
+        now).not_valid_after(now + datetime.timedelta(days=1)).sign(
+        key, hashes.SHA256())
+    return key, cert.public_bytes(serialization.Encoding.PEM)
+
+
+def signed_sns_message(key, message=TEST_MSG_SNS):
+    message = dict(message, SignatureVersion='1',
+                   SigningCertURL=TEST_CERT_URL)
+    message['Signature'] = b64encode(key.sign(
+        Message._sign_text(message), padding.PKCS1v15(),
+        hashes.SHA1())).decode('utf-8')
+    return message
+
 
 class TestMessageExtract(TestCase):
     @override_settings(AWS_SQS={'TEST': {}})
@@ -81,6 +119,44 @@ class TestMessageExtract(TestCase):
         self.assertEqual(
             body["EventDate"], '2018-08-21T21:00:56.832068-07:00')
 
+    @override_settings(AWS_SQS={'TEST': {'JSON_CODEC': 'auto'}})
+    def test_extract_inner_message_codec(self):
+        for msg in TEST_MESSAGES:
+            message = Message(msg, settings.AWS_SQS['TEST'])
+            self.assertEqual(message.extract(), msg)
+
+        message = Message(TEST_MSG_SNS_B64, settings.AWS_SQS['TEST'])
+        self.assertEqual(
+            message.extract()["EventID"],
+            '00000000-1111-2222-3333-444444444444')
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_extract_inner_message_base64_edges(self):
+        for msg, body in [
+                (TEST_MSG_SNS_B64['Message'] + '\n', 'EventID'),
+                (b64encode(b'not json').decode('utf-8'), b'not json'),
+                (b64encode(b'\xff\xfe').decode('utf-8'), b'\xff\xfe'),
+                ('ab==cdef', 'ab==cdef'),
+                ('12345', 12345),
+                ('café', 'café'),
+                ('héllo wörld!', 'héllo wörld!'),
+                ('', b'')]:
+            extracted = Message(msg, settings.AWS_SQS['TEST']).extract()
+            if isinstance(extracted, dict):
+                self.assertIn(body, extracted)
+            else:
+                self.assertEqual(extracted, body)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_published_at(self):
+        message = Message(TEST_MSG_SNS, settings.AWS_SQS['TEST'])
+        self.assertEqual(message.published_at(), 1534910456.843)
+        message = Message(TEST_MESSAGES[0], settings.AWS_SQS['TEST'])
+        self.assertIsNone(message.published_at())
+        message = Message(dict(TEST_MSG_SNS, Timestamp='now'),
+                          settings.AWS_SQS['TEST'])
+        self.assertIsNone(message.published_at())
+
 
 class TestMessageValidate(TestCase):
     @override_settings(AWS_SQS={'TEST': {}})
@@ -127,6 +203,136 @@ class TestMessageValidate(TestCase):
             str(cm.exception))
 
 
+class TestSignatureCache(TestCase):
+    def setUp(self):
+        key, pem = signing_cert()
+        self.key = key
+        public_key_cache.clear()
+        public_key_cache.set(TEST_CERT_URL, (
+            pem, Signature._load_public_key(pem)))
+
+    def tearDown(self):
+        public_key_cache.clear()
+
+    @override_settings(AWS_SQS={'TEST': {'VALIDATE_SNS_SIGNATURE': True}})
+    def test_validate_cached_signature(self):
+        for i in range(3):
+            message = Message(signed_sns_message(self.key),
+                              settings.AWS_SQS['TEST'])
+            self.assertTrue(message.validate())
+
+        stats = Signature.cache_stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(stats['size'], 1)
+
+    def test_single_flight_fetch(self):
+        pem, public_key = public_key_cache.get(TEST_CERT_URL)
+        public_key_cache.clear()
+        fetches = []
+
+        def fetch(signature, cert_ref, config):
+            fetches.append(cert_ref)
+            time.sleep(0.05)
+            public_key_cache.set(cert_ref, (pem, public_key))
+            return (pem, public_key)
+
+        conf = {'cert': {'type': 'url', 'reference': TEST_CERT_URL}}
+        with patch.object(Signature, '_fetch_public_key', fetch):
+            threads = [Thread(target=Signature, args=(conf,))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(fetches, [TEST_CERT_URL])
+        self.assertEqual(_fetch_locks, {})
+
+    @override_settings(AWS_SQS={'TEST': {'VALIDATE_SNS_SIGNATURE': True}})
+    def test_validate_cached_bad_signature(self):
+        msg = signed_sns_message(self.key)
+        msg['Subject'] = 'Tampered'
+        message = Message(msg, settings.AWS_SQS['TEST'])
+        with self.assertRaises(CryptoException) as cm:
+            message.validate()
+        self.assertIn('Cannot validate', str(cm.exception))
+
+    @override_settings(AWS_SQS={'TEST': {'VALIDATE_SNS_SIGNATURE': True}})
+    def test_validate_signatures_batch(self):
+        tampered = signed_sns_message(self.key)
+        tampered['Subject'] = 'Tampered'
+        unknown_cert = dict(signed_sns_message(self.key),
+                            SigningCertURL='https://invalid.pem')
+        messages = [Message(msg, settings.AWS_SQS['TEST']) for msg in [
+            signed_sns_message(self.key), tampered, unknown_cert,
+            TEST_MSG_SNS, signed_sns_message(self.key)]]
+
+        cert_failure_cache.set('https://invalid.pem', 'Cannot get cert')
+        Message.validate_signatures(messages)
+        cert_failure_cache.clear()
+
+        self.assertTrue(messages[0].validate())
+        self.assertTrue(messages[4].validate())
+        for i, error in [(1, 'Cannot validate'), (2, 'Cannot get cert'),
+                         (3, 'Unknown SNS Signature Version: 2')]:
+            with self.assertRaises(CryptoException) as cm:
+                messages[i].validate()
+            self.assertIn(error, str(cm.exception))
+
+        # one certificate lookup for each signing certificate url
+        self.assertEqual(Signature.cache_stats()['hits'], 1)
+
+    @override_settings(AWS_SQS={'TEST': {'VALIDATE_SNS_SIGNATURE': True}})
+    def test_validate_signatures_executor(self):
+        tampered = signed_sns_message(self.key)
+        tampered['Subject'] = 'Tampered'
+        messages = [Message(msg, settings.AWS_SQS['TEST']) for msg in [
+            signed_sns_message(self.key), tampered]]
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            Message.validate_signatures(messages, executor=executor)
+
+        self.assertTrue(messages[0].validate())
+        self.assertRaises(CryptoException, messages[1].validate)
+
+
+class MockPoolManager(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append(kwargs)
+        raise urllib3.exceptions.ConnectTimeoutError('timed out')
+
+
+class TestSignatureFetchFailure(TestCase):
+    def setUp(self):
+        public_key_cache.clear()
+        cert_failure_cache.clear()
+
+    def tearDown(self):
+        cert_failure_cache.clear()
+
+    @override_settings(AWS_CERT_CONNECT_TIMEOUT=1, AWS_CERT_READ_TIMEOUT=2,
+                       AWS_CERT_RETRIES=0, AWS_CERT_FAILURE_TTL=60,
+                       MEMCACHED_SERVERS=[])
+    def test_negative_cache(self):
+        http = MockPoolManager()
+        conf = {'cert': {'type': 'url', 'reference': TEST_CERT_URL}}
+        with patch('aws_message.crypto._pool_manager', return_value=http):
+            for i in range(3):
+                with self.assertRaises(CryptoException) as cm:
+                    Signature(conf)
+                self.assertIn('Cannot get certificate {}'.format(
+                    TEST_CERT_URL), str(cm.exception))
+
+        self.assertEqual(len(http.requests), 1)
+        self.assertEqual(http.requests[0]['timeout'].connect_timeout, 1)
+        self.assertEqual(http.requests[0]['timeout'].read_timeout, 2)
+        self.assertEqual(http.requests[0]['retries'].total, 0)
+        self.assertEqual(cert_failure_cache.stats()['hits'], 2)
+
+
 class TestMessageDecrypt(TestCase):
     def test_decrypt_message(self):
         AES_KEY = 'DUMMY_KEY_FOR_TESTING_1234567890'
@@ -135,3 +341,47 @@ class TestMessageDecrypt(TestCase):
         aes = aes128cbc(AES_KEY, AES_IV)
         msg = aes.decrypt(b'1234567812345678')
         self.assertIsNotNone(msg)
+
+    def test_decrypt_message_unpad(self):
+        AES_KEY = 'DUMMY_KEY_FOR_TESTING_1234567890'
+        AES_IV = 'DUMMY_IV_TESTING'
+        plain = b'{"message": "' + b'x' * 100000 + b'"}'
+
+        padder = sym_padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(AES_KEY.encode('utf8')),
+                           modes.CBC(AES_IV.encode('utf8'))).encryptor()
+        encrypted = encryptor.update(
+            padder.update(plain) + padder.finalize()) + encryptor.finalize()
+
+        aes = aes128cbc(AES_KEY, AES_IV)
+        aes.CHUNK_SIZE = 4096
+        self.assertEqual(aes.decrypt(encrypted, unpad=True), plain)
+        self.assertEqual(aes.decrypt(memoryview(encrypted), unpad=True),
+                         plain)
+        self.assertEqual(aes.decrypt(b64encode(encrypted).decode('utf8'),
+                                     unpad=True, b64=True), plain)
+        self.assertEqual(len(aes.decrypt(encrypted)), len(encrypted))
+
+        self.assertRaises(CryptoException, aes.decrypt, encrypted[:-1])
+        self.assertRaises(CryptoException, aes.decrypt,
+                          b'1234567812345678', unpad=True)
+        self.assertRaises(CryptoException, aes128cbc('short', AES_IV).decrypt,
+                          encrypted)
+
+    def test_decrypt_message_gcm(self):
+        key = AESGCM.generate_key(bit_length=256)
+        nonce = os.urandom(12)
+        plain = b'x' * 1000
+        encrypted = nonce + AESGCM(key).encrypt(nonce, plain, b'ad')
+
+        aes = aesgcm(key)
+        self.assertEqual(aes.decrypt(encrypted, associated_data=b'ad'), plain)
+        self.assertEqual(aes.decrypt(
+            encrypted[12:], nonce=nonce, associated_data=b'ad'), plain)
+        self.assertEqual(aes.decrypt(
+            b64encode(encrypted), associated_data=b'ad', b64=True), plain)
+
+        with self.assertRaises(CryptoException) as cm:
+            aes.decrypt(encrypted)
+        self.assertIn('authentication failed', str(cm.exception))
+        self.assertRaises(CryptoException, aes.decrypt, nonce)
@@ -0,0 +1,38 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from aws_message.metrics import Metrics, InMemoryMetrics
+
+
+class TestMetrics(TestCase):
+    def test_noop(self):
+        metrics = Metrics()
+        with metrics.timer('stage'):
+            metrics.incr('count')
+            metrics.observe('value', 1)
+
+    def test_in_memory(self):
+        metrics = InMemoryMetrics(max_samples=100)
+        for i in range(1, 201):
+            metrics.observe('value', i)
+        metrics.incr('count')
+        metrics.incr('count', 2)
+        with metrics.timer('stage'):
+            pass
+
+        self.assertEqual(metrics.counter('count'), 3)
+        self.assertEqual(metrics.counter('missing'), 0)
+        self.assertEqual(metrics.percentile('value', 50), 151)
+        self.assertIsNone(metrics.percentile('missing', 50))
+
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], {'count': 3})
+        self.assertEqual(summary['stats']['value']['count'], 200)
+        self.assertEqual(summary['stats']['value']['mean'], 100.5)
+        self.assertEqual(summary['stats']['value']['min'], 101)
+        self.assertEqual(summary['stats']['value']['p99'], 199)
+        self.assertEqual(summary['stats']['stage']['count'], 1)
+
+        metrics.reset()
+        self.assertEqual(metrics.summary(), {'counters': {}, 'stats': {}})
@@ -0,0 +1,132 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from commonconf import override_settings
+from aws_message.mock_sqs import SQSQueueMock
+from aws_message.sqs import SQSQueue
+from aws_message.tests.test_sqs import TestSQSQueue
+import os
+import sys
+import tempfile
+
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSQSQueueMock(TestCase):
+    def setUp(self):
+        self.clock = MockClock()
+        self.queue = SQSQueueMock(clock=self.clock)
+
+    def send(self, count, **kwargs):
+        for i in range(count):
+            self.queue.send_message(MessageBody='m{}'.format(i), **kwargs)
+
+    def test_receive_delete(self):
+        self.send(25)
+        messages = self.queue.receive_messages(MaxNumberOfMessages=10)
+        self.assertEqual([m.body for m in messages],
+                         ['m{}'.format(i) for i in range(10)])
+        self.assertEqual(messages[0].attributes['ApproximateReceiveCount'],
+                         '1')
+        self.assertEqual(self.queue.attributes, {
+            'ApproximateNumberOfMessages': '15',
+            'ApproximateNumberOfMessagesNotVisible': '10'})
+
+        response = self.queue.delete_messages(Entries=[
+            {'Id': str(i), 'ReceiptHandle': m.receipt_handle}
+            for i, m in enumerate(messages[:5])] + [
+            {'Id': 'x', 'ReceiptHandle': 'bogus'}])
+        self.assertEqual(len(response['Successful']), 5)
+        self.assertEqual(response['Failed'][0]['Id'], 'x')
+
+        messages[5].delete()
+        self.assertRaises(ClientError, messages[5].delete)
+        self.assertEqual(
+            self.queue.attributes['ApproximateNumberOfMessagesNotVisible'],
+            '4')
+
+    def test_visibility_timeout(self):
+        self.send(3)
+        first = self.queue.receive_messages(
+            MaxNumberOfMessages=2, VisibilityTimeout=10)
+        self.clock.now = 5
+        first[1].change_visibility(VisibilityTimeout=20)
+        self.clock.now = 11
+
+        # expired messages are redelivered ahead of the rest
+        again = self.queue.receive_messages(MaxNumberOfMessages=10)
+        self.assertEqual([m.body for m in again], ['m0', 'm2'])
+        self.assertEqual(again[0].attributes['ApproximateReceiveCount'], '2')
+        self.assertEqual(self.queue.delete_messages(Entries=[
+            {'Id': '0', 'ReceiptHandle': first[0].receipt_handle}])[
+            'Failed'][0]['Code'], 'ReceiptHandleIsInvalid')
+
+        self.clock.now = 26
+        self.assertEqual(
+            [m.body for m in self.queue.receive_messages(
+                MaxNumberOfMessages=10)], ['m1'])
+
+    def test_fifo_groups(self):
+        self.queue = SQSQueueMock(fifo=True, clock=self.clock)
+        self.assertRaises(ClientError, self.queue.send_message,
+                          MessageBody='m0')
+        self.send(3, MessageGroupId='a')
+        self.send(2, MessageGroupId='b')
+
+        messages = self.queue.receive_messages(MaxNumberOfMessages=4)
+        self.assertEqual([(m.attributes['MessageGroupId'], m.body)
+                          for m in messages],
+                         [('a', 'm0'), ('a', 'm1'), ('a', 'm2'),
+                          ('b', 'm0')])
+
+        # groups with messages in flight are not delivered from
+        self.send(1, MessageGroupId='a')
+        self.assertEqual(self.queue.receive_messages(MaxNumberOfMessages=4),
+                         [])
+
+        messages[3].delete()
+        self.assertEqual([m.body for m in self.queue.receive_messages(
+            MaxNumberOfMessages=4)], ['m1'])
+
+        for msg in messages[:3]:
+            msg.delete()
+        self.assertEqual([m.body for m in self.queue.receive_messages(
+            MaxNumberOfMessages=4)], ['m0'])
+
+    def test_sqs_queue(self):
+        sqs = SQSQueue(dict(TestSQSQueue._mock_settings, POLL_COUNT=100))
+        sqs._queue = self.queue
+        self.send(1000)
+        messages = sqs.get_messages()
+        self.assertEqual(len(messages), 1000)
+        self.assertEqual(sqs.delete_messages(messages), [])
+        self.assertEqual(self.queue.attributes, {
+            'ApproximateNumberOfMessages': '0',
+            'ApproximateNumberOfMessagesNotVisible': '0'})
+
+    @override_settings(INSTALLED_APPS=['mockapp'])
+    def test_mock_files(self):
+        with tempfile.TemporaryDirectory() as app_dir:
+            msg_dir = os.path.join(app_dir, 'mockapp', 'mock', 'aws_message',
+                                   'TEST')
+            os.makedirs(msg_dir)
+            open(os.path.join(app_dir, 'mockapp', '__init__.py'), 'w').close()
+            for i in range(2):
+                with open(os.path.join(
+                        msg_dir, 'message{}'.format(i)), 'w') as f:
+                    f.write('{{"id": {}}}'.format(i))
+
+            with patch.object(sys, 'path', [app_dir] + sys.path):
+                queue = SQSQueueMock(settings={'QUEUE': 'TEST'})
+
+        self.assertEqual([m.body for m in queue.get_messages()],
+                         ['{"id": 0}', '{"id": 1}'])
@@ -24,6 +24,13 @@ class MockProcessor(MessageBodyProcessor):
         self.current = json_data['Current']
 
 
+class MockFailingProcessor(MockProcessor):
+    def process_message_body(self, json_data):
+        if json_data.get('fail'):
+            raise ProcessorException('fail')
+        super(MockFailingProcessor, self).process_message_body(json_data)
+
+
 class MockInvalidProcessor(MockProcessor):
     def validate_message_body(self, message):
         return False
@@ -94,3 +101,11 @@ class TestMockProcessor(TestCase):
         self.assertEqual(
             processor.href, "...")
         self.assertIsNotNone(processor.current)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_process_batch(self):
+        processor = MockFailingProcessor()
+        failed = processor.process_batch([{'fail': True}, M1, {'fail': 1}])
+        self.assertEqual(failed, [0, 2])
+        self.assertEqual(processor.href, "...")
+        self.assertEqual(processor.process_batch([]), [])
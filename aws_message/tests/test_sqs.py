@@ -1,33 +1,90 @@
 # Copyright 2024 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
+from threading import Lock
+import time
 from unittest import TestCase
-from aws_message.sqs import SQSQueue, SQSException
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from aws_message.mock_sqs import SQSQueueMock
+from aws_message.sqs import (
+    SQSQueue, SQSException, VisibilityHeartbeat, sqs_client)
+
+
+class MockMessage(object):
+    def __init__(self, receipt_handle, deletable=True):
+        self.receipt_handle = receipt_handle
+        self.deletable = deletable
+        self.deleted = False
+
+    def delete(self):
+        if not self.deletable:
+            raise ClientError({'Error': {'Code': 'ReceiptHandleIsInvalid'}},
+                              'DeleteMessage')
+        self.deleted = True
 
 
 class MockQueue(object):
+    def __init__(self, fail_ids=()):
+        self.fail_ids = fail_ids
+        self.batches = []
+
     def receive_messages(self, **kwargs):
         return [''] * kwargs.get('MaxNumberOfMessages')
 
+    def change_message_visibility_batch(self, Entries):
+        return self.delete_messages(Entries)
+
+    def delete_messages(self, Entries):
+        self.batches.append(Entries)
+        return {
+            'Successful': [{'Id': e['Id']} for e in Entries if (
+                e['Id'] not in self.fail_ids)],
+            'Failed': [{'Id': e['Id'], 'Code': 'InternalError'}
+                       for e in Entries if e['Id'] in self.fail_ids]
+        }
+
 
 class MockEmptyQueue(MockQueue):
     def receive_messages(self, **kwargs):
         return []
 
 
+class MockErrorQueue(MockQueue):
+    def change_message_visibility_batch(self, Entries):
+        self.batches.append(Entries)
+        raise ClientError({'Error': {'Code': 'InternalError'}},
+                          'ChangeMessageVisibilityBatch')
+
+
+class MockDrainingQueue(MockQueue):
+    def __init__(self, depth):
+        super(MockDrainingQueue, self).__init__()
+        self.depth = depth
+        self.receives = 0
+        self.lock = Lock()
+
+    def receive_messages(self, **kwargs):
+        with self.lock:
+            self.receives += 1
+            count = min(self.depth, kwargs.get('MaxNumberOfMessages'))
+            self.depth -= count
+        return [''] * count
+
+
 class TestSQSQueue(TestCase):
-    def setUp(self):
-        self._mock_settings = {
-            'QUEUE_ARN': 'arn:aws:sqs:xx-mock-999:000000000000:ww-wwww-1',
-            'KEY_ID': 'XXXXXXXXXXXXXXXX',
-            'KEY': 'YYYYYYYYYYYYYYYYYYYYYYYY',
-            'WAIT_TIME': 10,
-            'VISIBILITY_TIMEOUT': 10,
-            'MESSAGE_GATHER_SIZE': 10,
-            'POLL_COUNT': 10,
-        }
+    _mock_settings = {
+        'QUEUE_ARN': 'arn:aws:sqs:xx-mock-999:000000000000:ww-wwww-1',
+        'KEY_ID': 'XXXXXXXXXXXXXXXX',
+        'KEY': 'YYYYYYYYYYYYYYYYYYYYYYYY',
+        'WAIT_TIME': 10,
+        'VISIBILITY_TIMEOUT': 10,
+        'MESSAGE_GATHER_SIZE': 10,
+        'POLL_COUNT': 10,
+    }
 
-        self.sqs = SQSQueue(self._mock_settings)
+    def setUp(self):
+        self.sqs = SQSQueue(dict(self._mock_settings))
         self.sqs._queue = MockQueue()
 
     def test_queue(self):
@@ -54,11 +111,205 @@ class TestSQSQueue(TestCase):
         messages = self.sqs.get_messages()
         self.assertEqual(len(messages), 9)
 
+    def test_get_messages_parallel(self):
+        self.sqs._settings['RECEIVE_WORKERS'] = 4
+        messages = self.sqs.get_messages()
+        self.assertEqual(len(messages), 100)
+
+        self.sqs._settings['POLL_COUNT'] = 3
+        messages = self.sqs.get_messages()
+        self.assertEqual(len(messages), 30)
+
+        self.sqs._queue = MockDrainingQueue(25)
+        self.sqs._settings['POLL_COUNT'] = 10
+        messages = self.sqs.get_messages()
+        self.assertEqual(len(messages), 25)
+        self.assertLess(self.sqs._queue.receives, 10)
+
     def test_empty_queue(self):
         self.sqs._queue = MockEmptyQueue()
         messages = self.sqs.get_messages()
         self.assertEqual(len(messages), 0)
 
+    def test_delete_messages(self):
+        messages = [MockMessage('rh{}'.format(i)) for i in range(25)]
+        self.assertEqual(self.sqs.delete_messages(messages), [])
+        self.assertEqual(
+            [len(b) for b in self.sqs._queue.batches], [10, 10, 5])
+        self.assertEqual(self.sqs._queue.batches[2][4]['ReceiptHandle'],
+                         'rh24')
+        self.assertFalse(any(msg.deleted for msg in messages))
+
+    def test_delete_messages_partial_failure(self):
+        self.sqs._queue = MockQueue(fail_ids=('1', '3'))
+        messages = [MockMessage('rh0'), MockMessage('rh1'),
+                    MockMessage('rh2'), MockMessage('rh3', deletable=False)]
+        not_deleted = self.sqs.delete_messages(messages)
+        self.assertEqual(not_deleted, [messages[3]])
+        self.assertTrue(messages[1].deleted)
+        self.assertFalse(messages[0].deleted)
+
+        self.assertEqual(self.sqs.delete_messages([]), [])
+
+    def test_change_visibility(self):
+        self.sqs._queue = MockQueue(fail_ids=('2',))
+        messages = [MockMessage('rh{}'.format(i)) for i in range(12)]
+        failed = self.sqs.change_visibility(messages, 30)
+        self.assertEqual(failed, [messages[2]])
+        self.assertEqual(
+            [len(b) for b in self.sqs._queue.batches], [10, 2])
+        self.assertEqual(self.sqs._queue.batches[1][1], {
+            'Id': '1', 'ReceiptHandle': 'rh11', 'VisibilityTimeout': 30})
+
+    def test_send_message(self):
+        self.sqs._queue = SQSQueueMock()
+        self.sqs.send_message('m0')
+        self.sqs.send_message('m1', message_attributes={
+            'a': {'DataType': 'String', 'StringValue': 'x'}})
+        messages = self.sqs._queue.receive_messages(MaxNumberOfMessages=2)
+        self.assertEqual([m.body for m in messages], ['m0', 'm1'])
+        self.assertEqual(messages[1].message_attributes['a']['StringValue'],
+                         'x')
+
+
+class TestSQSClient(TestCase):
+    QUEUE_URL = 'https://sqs.xx-mock-999.amazonaws.com/000000000000/ww-wwww-1'
+
+    def test_shared_client(self):
+        sqs = SQSQueue(TestSQSQueue._mock_settings)
+        other = SQSQueue(dict(TestSQSQueue._mock_settings,
+                              QUEUE_ARN='arn:aws:sqs:xx-mock-999:1:other'))
+        self.assertEqual(sqs.url, self.QUEUE_URL)
+        self.assertEqual(sqs._queue.url, self.QUEUE_URL)
+        self.assertIs(sqs._queue.client, other._queue.client)
+
+        pooled = SQSQueue(dict(TestSQSQueue._mock_settings,
+                               MAX_POOL_CONNECTIONS=50))
+        self.assertIsNot(pooled._queue.client, sqs._queue.client)
+        self.assertIs(pooled._queue.client, sqs_client(
+            sqs.key_id, sqs.key, sqs.region, max_pool_connections=50))
+        self.assertEqual(
+            pooled._queue.client.meta.config.max_pool_connections, 50)
+
+    def test_client_queue(self):
+        sqs = SQSQueue(dict(TestSQSQueue._mock_settings, POLL_COUNT=1))
+        with Stubber(sqs._queue.client) as stubber:
+            stubber.add_response('receive_message', {'Messages': [{
+                'MessageId': 'm0', 'ReceiptHandle': 'rh0', 'Body': '{}',
+                'Attributes': {'ApproximateReceiveCount': '2'}}]}, {
+                'QueueUrl': self.QUEUE_URL, 'AttributeNames': ['All'],
+                'MessageAttributeNames': ['All'], 'MaxNumberOfMessages': 10,
+                'WaitTimeSeconds': 10, 'VisibilityTimeout': 10})
+            stubber.add_response('delete_message_batch', {
+                'Successful': [], 'Failed': [{
+                    'Id': '0', 'SenderFault': False, 'Code': 'Error'}]}, {
+                'QueueUrl': self.QUEUE_URL, 'Entries': [
+                    {'Id': '0', 'ReceiptHandle': 'rh0'}]})
+            stubber.add_response('delete_message', {}, {
+                'QueueUrl': self.QUEUE_URL, 'ReceiptHandle': 'rh0'})
+
+            messages = sqs.get_messages()
+            self.assertEqual(len(messages), 1)
+            self.assertEqual(messages[0].message_id, 'm0')
+            self.assertEqual(
+                messages[0].attributes['ApproximateReceiveCount'], '2')
+            self.assertEqual(sqs.delete_messages(messages), [])
+            stubber.assert_no_pending_responses()
+
+
+class TestReceiveTuner(TestCase):
+    def setUp(self):
+        self.sqs = SQSQueue(dict(
+            TestSQSQueue._mock_settings, ADAPTIVE_RECEIVE=True,
+            ADAPTIVE_MAX_POLL_COUNT=5, ADAPTIVE_MAX_WAIT_TIME=30))
+        self.sqs._queue = SQSQueueMock()
+        self.now = 0
+        self.sqs._tuner._clock = lambda: self.now
+
+    def test_static_until_sampled(self):
+        self.assertIsNone(SQSQueue(TestSQSQueue._mock_settings)._tuner)
+        for name, value in [('POLL_COUNT', 5), ('WAIT_TIME', 10),
+                            ('VISIBILITY_TIMEOUT', 10),
+                            ('MESSAGE_GATHER_SIZE', 10)]:
+            self.assertEqual(self.sqs.receive_setting(name), value)
+
+    def test_backlog(self):
+        for i in range(35):
+            self.sqs._queue.send_message(MessageBody=str(i))
+
+        self.assertEqual(len(self.sqs.get_messages()), 35)
+        self.assertEqual(self.sqs._tuner.depth, 35)
+        self.assertEqual(self.sqs.receive_setting('POLL_COUNT'), 4)
+        self.assertEqual(self.sqs.receive_setting('WAIT_TIME'), 1)
+
+        # 0.2s per message, twice over for the 40 one cycle can receive
+        self.sqs.record_batch(35, 7)
+        self.assertEqual(self.sqs.receive_setting('VISIBILITY_TIMEOUT'), 16)
+        self.sqs.record_batch(35, 7000)
+        self.assertEqual(self.sqs.receive_setting('VISIBILITY_TIMEOUT'), 900)
+
+    def test_idle(self):
+        self.sqs._tuner.sample()
+        self.assertEqual(self.sqs._tuner.depth, 0)
+        self.assertEqual(self.sqs.receive_setting('POLL_COUNT'), 1)
+        self.assertEqual(self.sqs.receive_setting('WAIT_TIME'), 20)
+
+        # sampled again only after the interval
+        for i in range(100):
+            self.sqs._queue.send_message(MessageBody=str(i))
+        self.now = 29
+        self.sqs._tuner.sample()
+        self.assertEqual(self.sqs._tuner.depth, 0)
+        self.now = 30
+        self.sqs._tuner.sample()
+        self.assertEqual(self.sqs.receive_setting('POLL_COUNT'), 5)
+
+        # an empty receive means the queue has drained
+        self.sqs.record_batch(0, 0)
+        self.assertEqual(self.sqs.receive_setting('POLL_COUNT'), 1)
+
+
+class TestVisibilityHeartbeat(TestCase):
+    def setUp(self):
+        self.sqs = SQSQueue(TestSQSQueue._mock_settings)
+        self.sqs._queue = MockQueue(fail_ids=('0',))
+
+    def test_beat(self):
+        messages = [MockMessage('rh{}'.format(i)) for i in range(3)]
+        heartbeat = VisibilityHeartbeat(self.sqs, 30)
+        heartbeat.track(messages)
+        heartbeat.release(messages[1:2])
+        heartbeat.beat()
+        heartbeat.beat()
+        self.assertEqual(
+            [[e['ReceiptHandle'] for e in b] for b in self.sqs._queue.batches],
+            [['rh0', 'rh2'], ['rh2']])
+
+    def test_background(self):
+        heartbeat = VisibilityHeartbeat(self.sqs, 30, interval=0.01)
+        with heartbeat:
+            heartbeat.track([MockMessage('rh0'), MockMessage('rh1')])
+            time.sleep(0.1)
+
+        self.assertGreater(len(self.sqs._queue.batches), 1)
+        self.assertTrue(all(e['ReceiptHandle'] == 'rh1' and (
+            e['VisibilityTimeout'] == 30)
+            for b in self.sqs._queue.batches[1:] for e in b))
+        count = len(self.sqs._queue.batches)
+        heartbeat.beat()
+        self.assertEqual(len(self.sqs._queue.batches), count)
+
+    def test_background_error(self):
+        self.sqs._queue = MockErrorQueue()
+        heartbeat = VisibilityHeartbeat(self.sqs, 30, interval=0.01)
+        with heartbeat:
+            heartbeat.track([MockMessage('rh0')])
+            time.sleep(0.1)
+            # the thread outlives failed extensions and keeps trying
+            self.assertTrue(heartbeat._thread.is_alive())
+
+        self.assertGreater(len(self.sqs._queue.batches), 1)
+
 
 class TestSQSQueueErrors(TestCase):
     def test_queue_errors(self):
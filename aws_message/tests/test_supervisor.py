@@ -0,0 +1,87 @@
+# Copyright 2024 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import signal
+from unittest import TestCase
+from commonconf import override_settings
+from aws_message.supervisor import Supervisor, SupervisorException
+from aws_message.tests.test_gather import (
+    QUEUE_SETTINGS, MockProcessor, MockQueue)
+
+SUPERVISOR_SETTINGS = dict(QUEUE_SETTINGS, IDLE_BACKOFF_MIN=0.01,
+                           IDLE_BACKOFF_MAX=0.01)
+
+
+class MockCrashingProcessor(MockProcessor):
+    def process_message_body(self, json_data):
+        os._exit(3)
+
+
+class MockSupervisor(Supervisor):
+    """
+    Each worker gathers from its own copy of a mock queue, and the
+    supervisor stops once until() is true of its stats
+    """
+    def __init__(self, processor, until, **kwargs):
+        super(MockSupervisor, self).__init__(
+            processor=processor, sqs_settings=SUPERVISOR_SETTINGS,
+            restart_delay=0.05, stats_interval=0.05, drain_timeout=5,
+            **kwargs)
+        self.until = until
+
+    def _gather(self, metrics):
+        gather = super(MockSupervisor, self)._gather(metrics)
+        gather._queue._queue = MockQueue([{'id': i} for i in range(5)])
+        return gather
+
+    def _collect(self, timeout=0):
+        super(MockSupervisor, self)._collect(timeout)
+        if self.until(self.stats()):
+            self.stop()
+
+
+class TestSupervisor(TestCase):
+    def test_missing_processor(self):
+        self.assertRaises(SupervisorException, Supervisor)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_run(self):
+        supervisor = MockSupervisor(
+            MockProcessor(), workers=2,
+            until=lambda stats: len(stats['workers']) == 2 and (
+                stats['totals'].get('received') == 10))
+        supervisor.run(handle_signals=False)
+
+        stats = supervisor.stats()
+        self.assertEqual(stats['totals']['received'], 10)
+        self.assertEqual(stats['restarts'], 0)
+        for counters in stats['workers'].values():
+            self.assertEqual(counters['received'], 5)
+        self.assertEqual(supervisor._processes, [None, None])
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_restart(self):
+        supervisor = MockSupervisor(
+            MockCrashingProcessor(), workers=1,
+            until=lambda stats: stats['restarts'] >= 2)
+        supervisor.run(handle_signals=False)
+        self.assertGreaterEqual(supervisor.stats()['restarts'], 2)
+
+    @override_settings(AWS_SQS={'TEST': {}})
+    def test_worker_signals(self):
+        class MockSignalSupervisor(MockSupervisor):
+            def _gather(self, metrics):
+                if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL and (
+                        signal.getsignal(signal.SIGINT) is signal.SIG_DFL):
+                    metrics.incr('default_signals')
+                return super(MockSignalSupervisor, self)._gather(metrics)
+
+        handler = signal.getsignal(signal.SIGTERM)
+        supervisor = MockSignalSupervisor(
+            MockProcessor(), workers=1,
+            until=lambda stats: stats['totals'].get('received') == 5)
+        supervisor.run()
+
+        self.assertEqual(supervisor.stats()['totals']['default_signals'], 1)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), handler)